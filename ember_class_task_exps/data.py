@@ -1,8 +1,11 @@
+import os
 import copy
+import json
 import numpy as np
 from sklearn.utils import shuffle
 from torchvision import datasets, transforms
-from torch.utils.data import ConcatDataset, Dataset
+from torch.utils.data import ConcatDataset, Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
+from torch.utils.data.dataloader import default_collate
 import torch
 from sklearn.preprocessing import StandardScaler
 
@@ -10,37 +13,218 @@ from sklearn.preprocessing import StandardScaler
 class ExemplarDataset(Dataset):
     '''Create dataset from list of <np.arrays> with shape (N, C, H, W) (i.e., with N images each).
 
-    The images at the i-th entry of [exemplar_sets] belong to class [i], unless a [target_transform] is specified'''
+    The images at the i-th entry of [exemplar_sets] belong to class [i], unless a [target_transform] is specified.
+    The sets are copied into one contiguous array when the dataset is made and [class_ids] holds the
+    (untransformed) class of every row.'''
 
     def __init__(self, exemplar_sets, target_transform=None):
         super().__init__()
         self.exemplar_sets = exemplar_sets
         self.target_transform = target_transform
+        lengths = [len(exemplar_set) for exemplar_set in exemplar_sets]
+        non_empty = [np.asarray(exemplar_set) for exemplar_set in exemplar_sets if len(exemplar_set) > 0]
+        self.exemplars = np.concatenate(non_empty) if non_empty else np.empty((0,), dtype=np.float32)
+        self.class_ids = np.repeat(np.arange(len(lengths)), lengths)
 
     def __len__(self):
-        total = 0
-        for class_id in range(len(self.exemplar_sets)):
-            total += len(self.exemplar_sets[class_id])
-        return total
+        return len(self.exemplars)
 
     def __getitem__(self, index):
-        total = 0
-        for class_id in range(len(self.exemplar_sets)):
-            exemplars_in_this_class = len(self.exemplar_sets[class_id])
-            if index < (total + exemplars_in_this_class):
-                class_id_to_return = class_id if self.target_transform is None else self.target_transform(class_id)
-                exemplar_id = index - total
-                break
-            else:
-                total += exemplars_in_this_class
-        image = torch.from_numpy(self.exemplar_sets[class_id][exemplar_id])
+        if np.ndim(index) > 0:
+            return self.get_batch(index)
+        class_id = int(self.class_ids[index])
+        class_id_to_return = class_id if self.target_transform is None else self.target_transform(class_id)
+        image = torch.from_numpy(self.exemplars[index])
         return (image, class_id_to_return)
 
+    def get_batch(self, indices):
+        '''Exemplars [indices] as one contiguous tensor and their classes as one target tensor.'''
+        
+        indices = np.asarray(indices, dtype=np.int64)
+        return (torch.from_numpy(np.ascontiguousarray(self.exemplars[indices])),
+                torch.from_numpy(transform_targets(self.class_ids[indices], self.target_transform)))
+
+    def __getitems__(self, indices):
+        batch, targets = self.get_batch(indices)
+        return list(zip(batch, targets))
+
+
+
+
+class IndexedRows(object):
+    '''Rows [index] of the on-disk feature matrix [X], gathered from disk only when indexed.
+
+    Integer, slice and index-array keys are composed with [index]; array gathers read the
+    underlying rows in ascending order so the memmap is walked sequentially. Rows of a
+    float16/int8 store are dequantized with the per-column [scale] and [offset], one block
+    of [block_rows] at a time.'''
+
+    def __init__(self, X, index, scale=None, offset=None, block_rows=65536):
+        self.X = X
+        self.index = index
+        self.scale = scale
+        self.offset = offset
+        self.block_rows = block_rows
+        self.shape = (len(index),) + X.shape[1:]
+        self.dtype = X.dtype if scale is None else np.dtype(np.float32)
+
+    def __len__(self):
+        return len(self.index)
+
+    def _dequantize(self, block):
+        if self.scale is None:
+            return np.asarray(block)
+        return np.asarray(block).astype(np.float32) * self.scale + self.offset
+
+    def __getitem__(self, key):
+        rows = self.index[key]
+        if np.ndim(rows) == 0:
+            return self._dequantize(self.X[rows])
+        order = np.argsort(rows, kind='stable')
+        sorted_rows = rows[order]
+        gathered = np.empty((len(rows),) + self.X.shape[1:], dtype=self.dtype)
+        for start in range(0, len(rows), self.block_rows):
+            stop = start + self.block_rows
+            gathered[order[start:stop]] = self._dequantize(self.X[sorted_rows[start:stop]])
+        return gathered
+
+    def __array__(self, dtype=None, copy=None):
+        gathered = self[:]
+        return gathered if dtype is None else gathered.astype(dtype)
+
 
 
+class CSRRows(object):
+    '''Rows [index] of an on-disk CSR feature matrix ([indptr], [indices], [data]) with [ncols] columns.
+
+    Indexing densifies only the selected rows, so a batch is the only dense copy ever made;
+    csr() hands out the batch still compressed and subset() a view of some of the rows.'''
+
+    def __init__(self, indptr, indices, data, ncols, index):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.index = index
+        self.shape = (len(index), ncols)
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return len(self.index)
+
+    def csr(self, key):
+        rows = np.atleast_1d(self.index[key])
+        starts = np.asarray(self.indptr[rows], dtype=np.int64)
+        lengths = np.asarray(self.indptr[rows + 1], dtype=np.int64) - starts
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return indptr, np.asarray(self.indices[positions]), np.asarray(self.data[positions])
+
+    def subset(self, key):
+        return CSRRows(self.indptr, self.indices, self.data, self.shape[1], self.index[key])
+
+    def __getitem__(self, key):
+        indptr, indices, data = self.csr(key)
+        dense = np.zeros((len(indptr) - 1, self.shape[1]), dtype=np.float32)
+        dense[np.repeat(np.arange(len(indptr) - 1), np.diff(indptr)), indices] = data
+        return dense[0] if np.ndim(self.index[key]) == 0 else dense
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self[:]
+        return dense if dtype is None else dense.astype(dtype)
+
+
+class ScaledRows(object):
+    '''Rows of [rows] (e.g. a <CSRRows>) standardized with the fitted [scaler] and zero-padded
+    to [target_length_features], computed per indexed batch instead of for the whole split.'''
+
+    def __init__(self, rows, scaler, target_length_features=2401):
+        self.rows = rows
+        self.scaler = scaler
+        self.target_length_features = target_length_features
+        self.shape = (len(rows), max(rows.shape[1], target_length_features))
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, key):
+        block = np.asarray(self.rows[key], dtype=np.float32)
+        scaled = self.scaler.transform(block.reshape(-1, block.shape[-1])).astype(np.float32)
+        scaled = pad_features(scaled, self.target_length_features)
+        return scaled[0] if block.ndim == 1 else scaled
+
+    def __array__(self, dtype=None, copy=None):
+        scaled = self[:]
+        return scaled if dtype is None else scaled.astype(dtype)
+
+
+# on-disk file and dtype of each store format named in store.json
+STORE_FORMATS = {
+    'float32': ('X_train.dat', np.float32),
+    'float16': ('X_train.f16', np.float16),
+    'int8': ('X_train.q8', np.int8),
+}
+
+
+def open_feature_matrix(data_dir, nrows):
+    '''Memory-map the features of [data_dir] as (X, scale, offset); scale and offset are None for float32.'''
+
+    if not os.path.exists(data_dir + 'store.json'):
+        ndim = os.path.getsize(data_dir + 'X_train.dat') // (4 * nrows)
+        return np.memmap(data_dir + 'X_train.dat', dtype=np.float32, mode='r', shape=(nrows, ndim)), None, None
+
+    with open(data_dir + 'store.json', 'r') as fin:
+        store = json.load(fin)
+    file_name, dtype = STORE_FORMATS[store['dtype']]
+    X_ = np.memmap(data_dir + file_name, dtype=dtype, mode='r', shape=(store['nrows'], store['row_width']))
+    if store['dtype'] == 'float32':
+        return X_, None, None
+    return X_, np.load(data_dir + 'X_scale.npy'), np.load(data_dir + 'X_offset.npy')
+
+
+def load_csr_store(data_dir):
+    '''(indptr, indices, data, ncols) of a CSR store in [data_dir], memory-mapped, or None.'''
+
+    if not os.path.exists(data_dir + 'store.json'):
+        return None
+    with open(data_dir + 'store.json', 'r') as fin:
+        store = json.load(fin)
+    if store.get('format') != 'csr':
+        return None
+    indptr, indices, data = [np.load(data_dir + 'X_{}.npy'.format(name), mmap_mode='r')
+                             for name in ('indptr', 'indices', 'data')]
+    return indptr, indices, data, store['row_width']
+
+
+def load_indexed_split(data_dir, train=True):
+    '''Return (X, Y) of a split stored as row indices next to X_train.dat/y_train.dat, or None.'''
+
+    index_file = data_dir + ('train_index.npy' if train else 'test_index.npy')
+    if not os.path.exists(index_file):
+        return None
+    
+    return load_store_rows(data_dir, np.load(index_file))
+
+
+def load_store_rows(data_dir, index):
+    '''(X, Y) of the store rows [index] of [data_dir]; X is gathered from disk only when indexed.'''
+    
+    y_ = np.memmap(data_dir + 'y_train.dat', dtype=np.float32, mode='r')
+    csr_store = load_csr_store(data_dir)
+    if csr_store is not None:
+        return CSRRows(*csr_store, index=index), np.asarray(y_[index])
+    X_, scale, offset = open_feature_matrix(data_dir, len(y_))
+    
+    return IndexedRows(X_, index, scale, offset), np.asarray(y_[index])
+
 
 def V2_get_continual_ember_class_data(data_dir, train=True):
     
+    # splits written as index files are gathered lazily from X_train.dat
+    indexed_split = load_indexed_split(data_dir + '/', train=train)
+    if indexed_split is not None:
+        return indexed_split
+    
     if train:
         data_dir = data_dir + '/'
         XY_train = np.load(data_dir + 'XY_train.npz')
@@ -56,6 +240,90 @@ def V2_get_continual_ember_class_data(data_dir, train=True):
 
 
 
+def load_family_sorted_split(data_dir, selected_classes, train=True):
+    '''Rows of the families [selected_classes] of a split of a store written sorted by family, or None.
+
+    family_offsets.npy gives each family's contiguous row range of X_train.dat; intersecting
+    it with the split's sorted row indices selects the families' rows without reading the others.'''
+    
+    offsets_path = data_dir + 'family_offsets.npy'
+    index_file = data_dir + ('train_index.npy' if train else 'test_index.npy')
+    if not os.path.exists(offsets_path) or not os.path.exists(index_file):
+        return None
+    offsets = np.load(offsets_path)
+    index = np.sort(np.load(index_file))
+    bounds = np.searchsorted(index, offsets)
+    
+    families = np.asarray(selected_classes, dtype=np.int64)
+    families = families[(families >= 0) & (families < len(offsets) - 1)]
+    rows = np.concatenate([index[bounds[family]:bounds[family + 1]] for family in families] +
+                          [np.empty(0, dtype=np.int64)])
+    return load_store_rows(data_dir, rows)
+
+
+def merge_moments(a, b):
+    '''Combine per-column (count, mean, M2) moments of two disjoint sets of rows; None is no rows.'''
+    
+    if a is None or a[0] == 0:
+        return b
+    if b is None or b[0] == 0:
+        return a
+    count = a[0] + b[0]
+    delta = b[1] - a[1]
+    mean = a[1] + delta * (b[0] / count)
+    m2 = a[2] + b[2] + np.square(delta) * (a[0] * b[0] / count)
+    return count, mean, m2
+
+
+def load_train_moments(data_dir, labels=None):
+    '''Merged (count, mean, M2) of the train rows of [data_dir] with a label in [labels] (all if None).
+
+    Returns None for stores written without train_moments.npz.'''
+    
+    if not os.path.exists(data_dir + 'train_moments.npz'):
+        return None
+    moments = None
+    with np.load(data_dir + 'train_moments.npz') as stored:
+        keep = np.ones(len(stored['labels']), dtype=bool) if labels is None else np.isin(stored['labels'], labels)
+        for i in np.flatnonzero(keep):
+            moments = merge_moments(moments, (int(stored['count'][i]), stored['mean'][i], stored['m2'][i]))
+    return moments
+
+
+def scaler_from_moments(moments, n_features=None):
+    '''A fitted StandardScaler built from (count, mean, M2) moments instead of the data.
+
+    Columns beyond the stored ones (zero padding up to [n_features]) get mean 0 and scale 1.'''
+    
+    count, mean, m2 = moments
+    var = m2 / count
+    if n_features is not None and n_features > len(mean):
+        mean = np.concatenate([mean, np.zeros(n_features - len(mean))])
+        var = np.concatenate([var, np.zeros(n_features - len(var))])
+    scale = np.sqrt(var)
+    # constant columns are left unscaled, as StandardScaler does
+    scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.0
+    
+    scaler = StandardScaler()
+    scaler.n_samples_seen_ = count
+    scaler.mean_ = mean
+    scaler.var_ = var
+    scaler.scale_ = scale
+    scaler.n_features_in_ = len(mean)
+    return scaler
+
+
+def pad_features(X, target_length_features=2401):
+    
+    #make 2381 to 2401 so that the sqrt is 49; rows of a store written pre-padded pass through
+    X = np.asarray(X)
+    if X.shape[1] >= target_length_features:
+        return X
+    X_padded = np.zeros((X.shape[0], target_length_features), dtype=X.dtype)
+    X_padded[:, :X.shape[1]] = X
+    return X_padded
+
+
 def get_selected_classes(target_classes):
     classes_Y = [i for i in range(100)]
     #print(classes_Y)
@@ -65,37 +333,37 @@ def get_selected_classes(target_classes):
     return selected_classes
 
 
-def get_ember_selected_class_data(data_dir, selected_classes, train=True):
+def get_ember_selected_class_data(data_dir, selected_classes, train=True, seed=None):
     
     
-    if train:
+    # a family-sorted store only hands out the selected families' rows
+    family_split = load_family_sorted_split(data_dir + '/', selected_classes, train=train)
+    if family_split is not None:
+        all_X, all_Y = family_split
+    elif train:
         all_X, all_Y = V2_get_continual_ember_class_data(data_dir, train=True)
     else:
         all_X, all_Y = V2_get_continual_ember_class_data(data_dir, train=False)
     
-    X_ = []
-    Y_ = []
-
-    for ind, cls in enumerate(selected_classes):
-        get_ind_cls = np.where(all_Y == cls)
-        cls_X = all_X[get_ind_cls]
-        
-        #cls_Y = all_Y[get_ind_cls]
-
-        #assert len(cls_Y) == len(cls_X)
-
-        for j in range(len(cls_X)):
-            print("length:",len(cls_X[j]))
-            X_.append(cls_X[j])
-            Y_.append(ind)
-
+    # family id -> position in selected_classes (the task-local label), -1 if not selected
+    selected_classes = np.asarray(selected_classes, dtype=np.int64)
+    all_Y = np.asarray(all_Y).astype(np.int64)
+    lookup = np.full(max(all_Y.max(initial=0), selected_classes.max(initial=0)) + 1, -1, dtype=np.int64)
+    lookup[selected_classes] = np.arange(len(selected_classes))
+    local_Y = lookup[all_Y]
     
-
-    #from sklearn.utils import shuffle
-    X_ = np.float32(np.array(X_))
-    #X_ = np.array(X_)
-    Y_ = np.array(Y_, dtype=np.int64)
-    X_, Y_ = shuffle(X_, Y_)
+    # rows grouped by selected class, then shuffled (seeded if asked, else from np.random's
+    # global state like sklearn's shuffle) before the one gather of their features
+    rows = np.flatnonzero(local_Y >= 0)
+    rows = rows[np.argsort(local_Y[rows], kind='stable')]
+    if seed is None:
+        rows = rows[np.random.permutation(len(rows))]
+    else:
+        rows = rows[np.random.default_rng(seed).permutation(len(rows))]
+    
+    # CSR rows stay compressed, to be densified per batch
+    X_ = all_X.subset(rows) if isinstance(all_X, CSRRows) else np.asarray(all_X[rows], dtype=np.float32)
+    Y_ = local_Y[rows]
 
     
     if train:
@@ -245,17 +513,7 @@ class malwareSubDatasetExemplars(Dataset):
         self.dataset = original_dataset
         self.orig_length_features = orig_length_features
         self.target_length_features = target_length_features
-        self.sub_indeces = []
-        for index in range(len(self.dataset)):
-            if hasattr(original_dataset, "targets"):
-                if self.dataset.target_transform is None:
-                    label = self.dataset.targets[index]
-                else:
-                    label = self.dataset.target_transform(self.dataset.targets[index])
-            else:
-                label = self.dataset[index][1]
-            if label in sub_labels:
-                self.sub_indeces.append(index)
+        self.sub_indeces = np.flatnonzero(np.isin(dataset_labels(self.dataset), sub_labels))
         self.target_transform = target_transform
         
 
@@ -297,24 +555,30 @@ class malwareSubDataset(Dataset):
         self.orig_length_features = orig_length_features
         self.target_length_features = target_length_features
         
-        self.sub_indeces = []
-        for index in range(len(self.dataset)):
-            label = self.origlabels[index]
-            
-            if label in sub_labels:
-                self.sub_indeces.append(index)
+        self.sub_indeces = np.flatnonzero(np.isin(self.origlabels, sub_labels))
         self.target_transform = target_transform
         #self.transform = [transforms.Pad(2),
         #                  transforms.ToTensor(),
         #                 ]
+        
+        # rows of a pre-padded store are handed out as views, narrower rows are padded per sample
+        if self.dataset.shape[1] >= self.target_length_features:
+            self.padded_features = None
+        else:
+            self.padded_features = np.zeros(self.target_length_features - self.dataset.shape[1], dtype=np.float32)
 
     def __len__(self):
         return len(self.sub_indeces)
 
     def __getitem__(self, index):
         
-        self.padded_features = np.zeros(self.target_length_features - self.orig_length_features, dtype=np.float32)
-        sample = np.concatenate((self.dataset[self.sub_indeces[index]],self.padded_features))
+        # an index array (e.g. from get_batch_loader) fetches the whole batch at once
+        if np.ndim(index) > 0:
+            return self.get_batch(index)
+        
+        sample = self.dataset[self.sub_indeces[index]]
+        if self.padded_features is not None:
+            sample = np.concatenate((sample, self.padded_features))
         target = self.origlabels[self.sub_indeces[index]]
         
         #sample = self.transform(sample)
@@ -327,11 +591,26 @@ class malwareSubDataset(Dataset):
         #    target = self.origlabels[self.sub_indeces[index]]
         #print((sample, target))
         return (sample, target)    
+
+    def get_batch(self, indices):
+        '''Samples [indices] as one contiguous float32 tensor and one target tensor, from a single gather.'''
+        
+        rows = self.sub_indeces[np.asarray(indices, dtype=np.int64)]
+        batch = np.asarray(self.dataset[rows], dtype=np.float32)
+        if self.padded_features is not None:
+            batch = pad_features(batch, self.target_length_features)
+        return (torch.from_numpy(np.ascontiguousarray(batch)),
+                torch.from_numpy(transform_targets(self.origlabels[rows], self.target_transform)))
+
+    def __getitems__(self, indices):
+        # DataLoader's batched fetch: one gather, handed to the collate_fn as per-sample pairs
+        batch, targets = self.get_batch(indices)
+        return list(zip(batch, targets))
     
     
 def get_malware_multitask_experiment(dataset_name, target_classes, init_classes,\
                                      orig_feats_length, target_feats_length,\
-                                     scenario, tasks, data_dir, verbose=False):
+                                     scenario, tasks, data_dir, verbose=False, seed=None):
 
 
     if dataset_name == 'EMBER':
@@ -380,14 +659,34 @@ def get_malware_multitask_experiment(dataset_name, target_classes, init_classes,
         
         #data_dir = '../../../../ember2018/top_class_bases/top_classes_100' 
         data_dir = '/home/bae/continual-learning-malware/top_classes_100'
-        x_train, y_train = get_ember_selected_class_data(data_dir, selected_classes, train=True)
-        x_test, y_test = get_ember_selected_class_data(data_dir, selected_classes, train=False)
+        x_train, y_train = get_ember_selected_class_data(data_dir, selected_classes, train=True, seed=seed)
+        x_test, y_test = get_ember_selected_class_data(data_dir, selected_classes, train=False, seed=seed)
         
 
-        standardization = StandardScaler()
-        standard_scaler = standardization.fit(x_train)
-        x_train = standard_scaler.transform(x_train)
-        x_test = standard_scaler.transform(x_test)  
+        # the selected families' stored train moments give the same scaler as fitting on x_train
+        moments = load_train_moments(data_dir + '/', selected_classes)
+        sparse = isinstance(x_train, CSRRows)
+        if moments is not None:
+            standard_scaler = scaler_from_moments(moments, x_train.shape[1])
+        elif sparse:
+            standard_scaler = StandardScaler()
+            for start in range(0, len(x_train), 65536):
+                standard_scaler.partial_fit(x_train[start:start + 65536])
+        else:
+            standardization = StandardScaler()
+            standard_scaler = standardization.fit(x_train)
+        
+        if sparse:
+            # CSR rows are densified, scaled and padded one batch at a time
+            x_train = ScaledRows(x_train, standard_scaler, target_feats_length)
+            x_test = ScaledRows(x_test, standard_scaler, target_feats_length)
+        else:
+            x_train = standard_scaler.transform(x_train)
+            x_test = standard_scaler.transform(x_test)  
+            
+            # padded once here, so every per-task malwareSubDataset hands out row views
+            x_train = pad_features(x_train, target_feats_length)
+            x_test = pad_features(x_test, target_feats_length)
 
         ember_train, ember_test = (x_train, y_train), (x_test, y_test)
 
@@ -445,6 +744,8 @@ class TransformedDataset(Dataset):
         return len(self.dataset)
 
     def __getitem__(self, index):
+        if np.ndim(index) > 0:
+            return self.get_batch(index)
         (input, target) = self.dataset[index]
         if self.transform:
             input = self.transform(input)
@@ -452,6 +753,67 @@ class TransformedDataset(Dataset):
             target = self.target_transform(target)
         return (input, target)
 
+    def get_batch(self, indices):
+        '''Samples [indices] as one input tensor and one target tensor. Without a per-sample
+        [transform], a wrapped dataset with its own get_batch() is gathered in one go; anything
+        else is fetched item by item and collated.'''
+        
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.transform is not None or not hasattr(self.dataset, 'get_batch'):
+            inputs, targets = default_collate([self[index] for index in indices])
+            return (inputs, targets)
+        inputs, targets = self.dataset.get_batch(indices)
+        if self.target_transform:
+            targets = torch.from_numpy(transform_targets(targets.numpy(), self.target_transform))
+        return (inputs, targets)
+
+    def __getitems__(self, indices):
+        # a per-sample transform (e.g. ToTensor) expects what the wrapped dataset returns
+        if self.transform is not None:
+            return [self[index] for index in indices]
+        batch, targets = self.get_batch(indices)
+        return list(zip(batch, targets))
+
+
+def transform_targets(targets, target_transform=None):
+    '''Apply a per-label [target_transform] to a whole array of [targets].'''
+    
+    targets = np.asarray(targets)
+    if target_transform is None:
+        return targets
+    return np.array([target_transform(target) for target in targets])
+
+
+def dataset_labels(dataset):
+    '''Labels of all samples of [dataset] (after its target_transform) as one array.
+
+    Read from the label arrays behind the dataset, so no feature row is fetched; only a
+    dataset with none of those falls back to indexing every sample.'''
+    
+    if isinstance(dataset, ConcatDataset):
+        return np.concatenate([dataset_labels(part) for part in dataset.datasets])
+    if hasattr(dataset, 'targets'):
+        labels = dataset.targets
+    elif hasattr(dataset, 'origlabels'):
+        labels = np.asarray(dataset.origlabels)[dataset.sub_indeces]
+    elif hasattr(dataset, 'class_ids'):
+        labels = dataset.class_ids
+    elif isinstance(getattr(dataset, 'dataset', None), Dataset):
+        labels = dataset_labels(dataset.dataset)
+        if hasattr(dataset, 'sub_indeces'):
+            labels = labels[dataset.sub_indeces]
+    else:
+        return np.array([dataset[index][1] for index in range(len(dataset))])
+    return transform_targets(labels, getattr(dataset, 'target_transform', None))
+
+
+def get_batch_loader(dataset, batch_size, shuffle=True, drop_last=False, **kwargs):
+    '''DataLoader handing whole index batches to [dataset], so each batch is one get_batch() gather
+    rather than [batch_size] single-item fetches and a collate.'''
+    
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last), batch_size=None, **kwargs)
+
 
 
 
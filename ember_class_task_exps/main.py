@@ -233,7 +233,7 @@ def run(args, verbose=True):
         dataset_name=args.data_set, target_classes=target_classes, init_classes=init_classes,\
         scenario=scenario, orig_feats_length=orig_feats_length,\
         target_feats_length=target_feats_length, tasks=args.tasks, data_dir=args.d_dir,
-        verbose=verbose)
+        verbose=verbose, seed=args.seed)
     
     
     #num_training_samples = 303331
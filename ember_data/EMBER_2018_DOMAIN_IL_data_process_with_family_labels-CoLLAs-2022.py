@@ -12,90 +12,80 @@ import random
 import time
 import multiprocessing
 from ember_features import PEFeatureExtractor
-
-def vectorize(irow, raw_features_string, X_path, y_path, extractor, nrows):
-    """
-    Vectorize a single sample of raw features and write to a large numpy file
-    """
-    raw_features = json.loads(raw_features_string)
-    
-    feature_vector = extractor.process_raw_features(raw_features)
-
-    y = np.memmap(y_path, dtype=np.float32, mode="r+", shape=nrows)
-    y[irow] = raw_features["label"]
-    
-
-    X = np.memmap(X_path, dtype=np.float32, mode="r+", shape=(nrows, extractor.dim))
-    X[irow] = feature_vector
-
-
-def vectorize_unpack(args):
-    """
-    Pass through function for unpacking vectorize arguments
-    """
-    return vectorize(*args)
-
-
+from feature_store import vectorize_rows, vectorize_byte_ranges, write_metadata_sidecar, load_metadata_sidecar, selection_fingerprint, split_rows, split_keys, write_split_indices, write_split_moments, finalize_feature_store, open_feature_matrix, dequantize
+from raw_index import raw_feature_paths_for, get_raw_index, select_rows, dedup_rows, row_offsets, skipped_offsets, index_line_iterator, filtered_line_iterator, make_row_filter
 
 def create_parent_folder(file_path):
     if not os.path.exists(os.path.dirname(file_path)):
         os.makedirs(os.path.dirname(file_path))
         
-def raw_feature_iterator(file_paths, task_months):
+def raw_feature_iterator(file_paths, task_months, use_index=True, dedup=True):
     """
     Yield raw feature strings from the inputed file paths
     """
-    for path in file_paths:
-        with open(path, "r") as fin:
-            for line in fin:
-                raw_features = json.loads(line)
-                if raw_features['appeared'] in task_months:
-                    yield line
+    if not use_index:
+        # stream the shards, only the head of each line is sniffed for the filtering fields
+        for line in filtered_line_iterator(file_paths, task_months, dedup=dedup):
+            yield line
+        return
+    
+    index, meta = get_raw_index(file_paths)
+    mask = select_rows(index, meta, task_months)
+    if dedup:
+        mask, duplicates = dedup_rows(index, mask)
+    for line in index_line_iterator(file_paths, index, mask):
+        yield line
 
 
-def task_based_vectorize_subset(X_path, y_path, raw_feature_paths, task_months, extractor, nrows):
+def task_based_vectorize_subset(X_path, y_path, raw_feature_paths, task_months, extractor, nrows, byte_ranges=True, cache_dir=None, row_width=None, dedup=True, fingerprint=None):
     """
     Vectorize a subset of data and write it to disk
     """
-    # Create space on disk to write features to
-    X = np.memmap(X_path, dtype=np.float32, mode="w+", shape=(nrows, extractor.dim))
-    y = np.memmap(y_path, dtype=np.float32, mode="w+", shape=nrows)
+    if byte_ranges:
+        # Workers parse and filter their own slices of the shards; the parent never reads lines
+        # repeated samples are told to the workers by position, they never see the index;
+        # the per-range row counts come from the offsets of the selected rows
+        index, meta, mask, duplicates = task_row_mask(raw_feature_paths, task_months, dedup)
+        skip = skipped_offsets(raw_feature_paths, index, duplicates) if dedup else None
+        vectorize_byte_ranges(X_path, y_path, raw_feature_paths, make_row_filter(task_months, skip=skip),
+                              extractor, nrows, cache_dir=cache_dir, row_width=row_width,
+                              selected_offsets=row_offsets(raw_feature_paths, index, mask), fingerprint=fingerprint)
+        return
+    
+    # Workers map X/y once and write chunks of rows; labels are the raw malware/goodware labels
+    vectorize_rows(X_path, y_path, raw_feature_iterator(raw_feature_paths, task_months, dedup=dedup),
+                   extractor, nrows, cache_dir=cache_dir, row_width=row_width, fingerprint=fingerprint)
 
-    del X, y
+        
+def task_row_mask(raw_feature_paths, task_months, dedup=True):
+    """
+    Raw index rows of [task_months]; with [dedup], rows repeating an earlier sha256 of the
+    selection are moved from the mask to the returned duplicates
+    """
+    index, meta = get_raw_index(raw_feature_paths)
+    mask = select_rows(index, meta, task_months)
+    duplicates = np.zeros(len(index), dtype=bool)
+    if dedup:
+        mask, duplicates = dedup_rows(index, mask)
+    return index, meta, mask, duplicates
 
-    # Distribute the vectorization work
-    pool = multiprocessing.Pool()
-    argument_iterator = ((irow, raw_features_string, X_path, y_path, extractor, nrows)
-                         for irow, raw_features_string in enumerate(raw_feature_iterator(raw_feature_paths, task_months)))
-    #print(argument_iterator)
-    
-    
-    for _ in tqdm.tqdm(pool.imap_unordered(vectorize_unpack, argument_iterator), total=nrows):
-        pass
-    
-    #return argument_iterator
 
-        
-def task_num_rows(raw_feature_paths, task_months):
-    cnt_rows = 0
+def task_num_rows(raw_feature_paths, task_months, dedup=True):
+    index, meta, mask, duplicates = task_row_mask(raw_feature_paths, task_months, dedup)
+    cnt_rows = int(np.count_nonzero(mask))
     
-    family_labels = []
-    
-    for fp in raw_feature_paths:
-        #print(fp)
-        with open(fp, "r") as fin:
-            #print(fp)
-            for line in fin:
-                raw_features = json.loads(line)
-                if raw_features['appeared'] in task_months:
-                    family_labels.append(raw_features['avclass'])
-                    cnt_rows += 1
-    return cnt_rows, family_labels
+    return cnt_rows
 
 
-def create_task_based_vectorized_features(data_dir, save_dir, current_task, task_months, feature_version=2):
+def create_task_based_vectorized_features(data_dir, save_dir, current_task, task_months, feature_version=2, row_width=None, store_dtype='float32', sparse=False, dedup=True, extra_shards=None):
     """
-    Create feature vectors from raw features and write them to disk
+    Create feature vectors from raw features and write them to disk.
+    Only the rows of [current_task] are vectorized.
+    With [row_width] set, rows are stored zero-padded to that width.
+    [store_dtype] 'float16' or 'int8' keeps a reduced-precision copy in place of X_train.dat,
+    [sparse] a CSR copy (X_indptr/X_indices/X_data.npy).
+    With [dedup], a sample whose sha256 already occurred in the month is only vectorized once.
+    [extra_shards] are raw feature files read after the seven EMBER 2018 shards.
     """
     extractor = PEFeatureExtractor(feature_version)
     
@@ -105,85 +95,95 @@ def create_task_based_vectorized_features(data_dir, save_dir, current_task, task
     
     #y_path_family_labels = os.path.join(save_dir, "y_family_train.dat")
     
-    raw_feature_paths_base_tr = [os.path.join(data_dir, "train_features_{}.jsonl".format(i)) for i in range(6)]
-    raw_feature_paths_base_te = [os.path.join(data_dir, "test_features.jsonl")]
-    raw_feature_paths = raw_feature_paths_base_tr + raw_feature_paths_base_te
-    
-    nrows, family_labels = task_num_rows(raw_feature_paths, current_task)
-    #print(nrows)
+    raw_feature_paths = raw_feature_paths_for(data_dir, extra_shards)
+    # shared by both preprocessing scripts and every rerun
+    cache_dir = os.path.join(data_dir, "feature_cache_v{}".format(feature_version))
     
-    save_test_file = save_dir + 'task_family_labels.npz'
-    np.savez(save_test_file, family_labels=family_labels)
+    index, meta, mask, duplicates = task_row_mask(raw_feature_paths, [current_task], dedup)
+    nrows = int(np.count_nonzero(mask))
+    print(f'{np.count_nonzero(duplicates)} duplicate sha256 rows dropped, {nrows} rows to vectorize')
     
+    # family codes, labels, months and digests of every row, as memory-mappable columns
+    write_metadata_sidecar(save_dir, index, meta, mask)
     
-    task_based_vectorize_subset(X_path, y_path, raw_feature_paths, current_task, extractor, nrows)
-    #argument_iterator = task_based_vectorize_subset(X_path, y_path, raw_feature_paths, task_months, extractor, nrows)
+    # a store left by an interrupted run is only resumed if it was started for the same rows
+    fingerprint = selection_fingerprint(load_metadata_sidecar(save_dir)['sha256'])
+    task_based_vectorize_subset(X_path, y_path, raw_feature_paths, [current_task], extractor, nrows, cache_dir=cache_dir, row_width=row_width, dedup=dedup, fingerprint=fingerprint)
+    finalize_feature_store(save_dir, nrows, row_width or extractor.dim, store_dtype, sparse=sparse)
     
-    #return argument_iterator
+    return {'month': current_task, 'nrows': nrows, 'dim': extractor.dim,
+            'row_width': row_width or extractor.dim, 'dtype': store_dtype}
 
-def read_task_based_vectorized_features(save_dir, feature_version=2):
+
+def write_month_store(save_dir, month_store):
     """
-    Read vectorized features into memory mapped numpy arrays
+    Mark the month in [save_dir] as done. Call it only once the split and moments are written
+    too, so an interrupted month is redone on the next run instead of skipped half-finished.
+    """
+    with open(os.path.join(save_dir, "month_store.json"), "w") as fout:
+        json.dump(month_store, fout)
+
+
+def month_is_vectorized(save_dir):
+    return os.path.exists(os.path.join(save_dir, "month_store.json"))
+
+
+def read_task_based_vectorized_features(save_dir, feature_version=2, split_mode='index', seed=0, stratify=None, hash_split=False):
+    """
+    Read vectorized features into memory mapped numpy arrays and split them 90/10.
+    split_mode 'index' only writes seeded train/test row indices into X_train.dat,
+    'npz' writes full copies of both splits to XY_train.npz and XY_test.npz.
+    Either way the moments of the train rows are saved to train_moments.npz for the scaler.
+    The split is seeded by [seed], stratified by [stratify] ('label' or 'family') if given and
+    derived from the samples' sha256 if [hash_split] (see feature_store.split_rows).
     """
 
-    extractor = PEFeatureExtractor(feature_version)
-    ndim = extractor.dim
     X_ = None
     y_ = None
 
 
-    X_path = os.path.join(save_dir, "X_train.dat")
     y_path = os.path.join(save_dir, "y_train.dat")
     
     y_ = np.memmap(y_path, dtype=np.float32, mode="r")
     N = y_.shape[0]
-    
-    X_ = np.memmap(X_path, dtype=np.float32, mode="r", shape=(N, ndim))
+    # float32, float16 or int8 codes as recorded in store.json; rows may be padded
+    X_, scale, offset = open_feature_matrix(save_dir)
     
     print(np.unique(y_))
     
-    goodware_indices = []
-    malware_indices = []
-    
+    # unlabeled (-1) rows drop out of the masks and are never copied
+    goodware_indices = np.flatnonzero(y_ == 0)
+    malware_indices = np.flatnonzero(y_ == 1)
     
-    for ind, i in enumerate(y_):
-        if i == 0:
-            goodware_indices.append(ind)
-        elif i == 1:
-            malware_indices.append(ind)
-        else:
-            pass
+    malware_goodware_indices = np.concatenate([goodware_indices, malware_indices])
     
-    malware_goodware_indices = goodware_indices + malware_indices
+    print(len(malware_goodware_indices), len(goodware_indices), len(malware_indices))
     
-    print(len(y_[malware_goodware_indices]), len(y_[goodware_indices]), len(y_[malware_indices]))
+    strata, digests = split_keys(save_dir, malware_goodware_indices, stratify, hash_split)
     
+    if split_mode == 'index':
+        train_rows, test_rows = write_split_indices(save_dir, malware_goodware_indices, seed=seed, strata=strata, digests=digests)
+        write_split_moments(save_dir, train_rows)
+        print(f'train rows {train_rows.shape} test rows {test_rows.shape}')
+        return
     
-    Y_family_labels_file = save_dir + 'task_family_labels.npz'
-    Y_fam_labels_ = np.load(Y_family_labels_file)
-    Y_fam_labels = Y_fam_labels_['family_labels']
     
+    # family codes into meta_vocab.json rather than avclass strings
+    Y_fam_labels = load_metadata_sidecar(save_dir)['family']
     
-    X = X_[malware_goodware_indices]
-    Y = y_[malware_goodware_indices]
-    Y_families = Y_fam_labels[malware_goodware_indices]
-    
-    indx = [i for i in range(len(Y))]
-    random.shuffle(indx)
-
-    train_size = int(len(indx)*0.9)
-    trainset = indx[:train_size]
-    testset = indx[train_size:]
+    # the split is composed on store rows, so each array is gathered from disk exactly once
+    trainset, testset = split_rows(malware_goodware_indices, seed=seed, strata=strata, digests=digests)
+    write_split_moments(save_dir, trainset)
 
     # Separate the training set
-    X_train = X[trainset]
-    Y_train = Y[trainset]
-    Y_family_train = Y_families[trainset]
+    X_train = dequantize(X_[trainset], scale, offset)
+    Y_train = y_[trainset]
+    Y_family_train = Y_fam_labels[trainset]
 
     # Separate the test set
-    X_test = X[testset]
-    Y_test = Y[testset]
-    Y_family_test = Y_families[testset]
+    X_test = dequantize(X_[testset], scale, offset)
+    Y_test = y_[testset]
+    Y_family_test = Y_fam_labels[testset]
     
     
     print(f'X_train {X_train.shape} Y_train {Y_train.shape} Y_family_train {Y_family_train.shape}\n X_test {X_test.shape} Y_test {Y_test.shape} \n Y_family_test {Y_family_test.shape}')
@@ -219,8 +219,13 @@ for task in range(0,len(all_task_months)):
     
     print(f'Processing data for task {current_task}')
     #print(current_task, task_months)
-    create_task_based_vectorized_features(data_dir, save_dir, current_task, task_months, feature_version=2)
-    read_task_based_vectorized_features(save_dir, feature_version=2)
+    # every month is vectorized once; rerunning after a new month lands only extracts that month
+    if month_is_vectorized(save_dir):
+        print(f'{current_task} already vectorized, skipping')
+    else:
+        month_store = create_task_based_vectorized_features(data_dir, save_dir, current_task, task_months, feature_version=2, row_width=2401)
+        read_task_based_vectorized_features(save_dir, feature_version=2)
+        write_month_store(save_dir, month_store)
     
     
     end_time = time.time()
@@ -12,6 +12,9 @@ import random
 import time
 import multiprocessing
 from ember_features import PEFeatureExtractor
+from feature_store import vectorize_rows, vectorize_byte_ranges, write_metadata_sidecar, load_metadata_sidecar, selection_fingerprint, split_rows, split_keys, write_split_indices, write_split_moments, write_family_offsets, store_order, finalize_feature_store, open_feature_matrix, dequantize
+from family_stats import update_family_counts, family_stat, top_families
+from raw_index import raw_feature_paths_for, get_raw_index, select_rows, dedup_rows, row_offsets, skipped_offsets, index_line_iterator, filtered_line_iterator, make_row_filter
 
 from datetime import datetime
 import os
@@ -25,48 +28,20 @@ import copy
 # In[ ]:
 
 
-def get_emberdata_family_stat(data_dir):
+def get_emberdata_family_stat(data_dir, extra_shards=None):
     #data_dir = "../../ember/ember_data/2018_data/ember2018/"
     
-    raw_feature_paths_base_tr = [os.path.join(data_dir, "train_features_{}.jsonl".format(i)) for i in range(6)]
-    raw_feature_paths_base_te = [os.path.join(data_dir, "test_features.jsonl")]
-    raw_feature_paths = raw_feature_paths_base_tr + raw_feature_paths_base_te
+    raw_feature_paths = raw_feature_paths_for(data_dir, extra_shards)
     #print(raw_feature_paths)
 
     all_task_months = ['2018-01', '2018-02', '2018-03', '2018-04', '2018-05', '2018-06',
                        '2018-07', '2018-08', '2018-09', '2018-10', '2018-11', '2018-12']
     task_months = all_task_months
 
-    av_class_stats = {}
-    cnt_rows = 0
-    cnt_good_rows = 0
-    cnt_missing_rows = 0
-
-    for fp in raw_feature_paths:
-        #print(fp)
-        with open(fp, "r") as fin:
-            #print(fp)
-            for line in fin:
-                raw_features = json.loads(line)
-                #print(raw_features.keys())
-
-                if raw_features['appeared'] in task_months:
-                    if raw_features['label'] == 1: # and raw_features['avclass']
-                        #print(raw_features['label'], raw_features['avclass'])
-                        if raw_features['avclass'] not in av_class_stats.keys():
-                            av_class_stats[raw_features['avclass']] = 1
-                        else:
-                            av_class_stats[raw_features['avclass']] += 1
-                        cnt_rows += 1
-
-                    elif raw_features['label'] == 0:
-                        cnt_good_rows += 1
-                    elif raw_features['label'] == -1:
-                        #print(raw_features['label'], raw_features['avclass'])
-                        cnt_missing_rows += 1
-
-            #if cnt_rows == 2:
-            #    break
+    # answered from persisted per-month counters, folded in from the raw index shard by shard
+    family_counts = update_family_counts(raw_feature_paths, data_dir)
+    av_class_stats, cnt_good_rows, cnt_missing_rows = family_stat(family_counts, task_months)
+
     min_samples = 0
 
     families_more_than_400_samples = {}
@@ -75,154 +50,164 @@ def get_emberdata_family_stat(data_dir):
         if v >= min_samples and k != '':
             families_more_than_400_samples[k] = v
             
-    return families_more_than_400_samples, av_class_stats
+    return families_more_than_400_samples, av_class_stats, family_counts
 
 
 # In[ ]:
 
 
-def vectorize(irow, raw_features_string, X_path, y_path, extractor, nrows):
-    """
-    Vectorize a single sample of raw features and write to a large numpy file
-    """
-    raw_features = json.loads(raw_features_string)
-    
-    feature_vector = extractor.process_raw_features(raw_features)
-
-    y = np.memmap(y_path, dtype=np.float32, mode="r+", shape=nrows)
-    y[irow] = top_families_100_labels[raw_features["avclass"]]
-
-    X = np.memmap(X_path, dtype=np.float32, mode="r+", shape=(nrows, extractor.dim))
-    X[irow] = feature_vector
-
-
-def vectorize_unpack(args):
-    """
-    Pass through function for unpacking vectorize arguments
-    """
-    return vectorize(*args)
-
-
-
 def create_parent_folder(file_path):
     if not os.path.exists(os.path.dirname(file_path)):
         os.makedirs(os.path.dirname(file_path))
         
-def raw_feature_iterator(file_paths, top_families):
+def raw_feature_iterator(file_paths, top_families, use_index=True, dedup=True):
     """
     Yield raw feature strings from the inputed file paths
     """
     all_task_months = ['2018-01', '2018-02', '2018-03', '2018-04', '2018-05', '2018-06',
                    '2018-07', '2018-08', '2018-09', '2018-10', '2018-11', '2018-12']
     
-    for path in file_paths:
-        with open(path, "r") as fin:
-            for line in fin:
-                raw_features = json.loads(line)
-                if raw_features['appeared'] in all_task_months:
-                    if raw_features['avclass'] != '':
-                        if raw_features['avclass'] in top_families and raw_features['label'] == 1:
-                            yield line
+    if not use_index:
+        # stream the shards, only the head of each line is sniffed for the filtering fields
+        for line in filtered_line_iterator(file_paths, all_task_months, families=top_families, labels=[1], dedup=dedup):
+            yield line
+        return
+    
+    index, meta = get_raw_index(file_paths)
+    mask = select_rows(index, meta, all_task_months, families=top_families, labels=[1])
+    if dedup:
+        mask, duplicates = dedup_rows(index, mask)
+    for line in index_line_iterator(file_paths, index, mask):
+        yield line
 
 
-def task_based_vectorize_subset(X_path, y_path, raw_feature_paths, top_families, extractor, nrows):
+def task_based_vectorize_subset(X_path, y_path, raw_feature_paths, top_families, extractor, nrows, byte_ranges=True, cache_dir=None, row_width=None, dedup=True, row_order=None, fingerprint=None):
     """
-    Vectorize a subset of data and write it to disk
+    Vectorize a subset of data and write it to disk, the i-th selected row to row_order[i] if given
     """
-    # Create space on disk to write features to
-    X = np.memmap(X_path, dtype=np.float32, mode="w+", shape=(nrows, extractor.dim))
-    y = np.memmap(y_path, dtype=np.float32, mode="w+", shape=nrows)
-    del X, y
-
-    # Distribute the vectorization work
-    pool = multiprocessing.Pool()
-    argument_iterator = ((irow, raw_features_string, X_path, y_path, extractor, nrows)
-                         for irow, raw_features_string in enumerate(raw_feature_iterator(raw_feature_paths, top_families)))
-    #print(argument_iterator)
-    
-    
-    for _ in tqdm.tqdm(pool.imap_unordered(vectorize_unpack, argument_iterator), total=nrows):
-        pass
+    if byte_ranges:
+        # Workers parse and filter their own slices of the shards; the parent never reads lines
+        all_task_months = ['2018-01', '2018-02', '2018-03', '2018-04', '2018-05', '2018-06',
+                       '2018-07', '2018-08', '2018-09', '2018-10', '2018-11', '2018-12']
+        # repeated samples are told to the workers by position, they never see the index;
+        # the per-range row counts come from the offsets of the selected rows
+        index, meta, mask, duplicates = task_row_mask(raw_feature_paths, top_families, dedup)
+        skip = skipped_offsets(raw_feature_paths, index, duplicates) if dedup else None
+        row_filter = make_row_filter(all_task_months, families=top_families, labels=[1], skip=skip)
+        vectorize_byte_ranges(X_path, y_path, raw_feature_paths, row_filter,
+                              extractor, nrows, label_map=top_families_100_labels, cache_dir=cache_dir, row_width=row_width,
+                              selected_offsets=row_offsets(raw_feature_paths, index, mask), row_order=row_order, fingerprint=fingerprint)
+        return
     
-    #return argument_iterator
+    # Workers map X/y once and write chunks of rows; labels are the top family ids
+    vectorize_rows(X_path, y_path, raw_feature_iterator(raw_feature_paths, top_families, dedup=dedup),
+                   extractor, nrows, label_map=top_families_100_labels, cache_dir=cache_dir, row_width=row_width, row_order=row_order, fingerprint=fingerprint)
 
         
-def task_num_rows(raw_feature_paths, top_families):
-    print(top_families)
+def task_row_mask(raw_feature_paths, top_families, dedup=True):
+    """
+    Raw index rows of the [top_families] malware; with [dedup], rows repeating an earlier
+    sha256 of the selection are moved from the mask to the returned duplicates
+    """
     all_task_months = ['2018-01', '2018-02', '2018-03', '2018-04', '2018-05', '2018-06',
                    '2018-07', '2018-08', '2018-09', '2018-10', '2018-11', '2018-12']
-    cnt_rows = 0
-    for fp in raw_feature_paths:
-        #print(fp)
-        with open(fp, "r") as fin:
-            #print(fp)
-            for line in fin:
-                raw_features = json.loads(line)
-                if raw_features['appeared'] in all_task_months:
-                    if raw_features['avclass'] != '':
-                        if raw_features['avclass'] in top_families and raw_features['label'] == 1:
-                            cnt_rows += 1
-    return cnt_rows
-
-
-def create_task_based_vectorized_features(data_dir, save_dir, top_families, feature_version=2):
+    index, meta = get_raw_index(raw_feature_paths)
+    mask = select_rows(index, meta, all_task_months, families=top_families, labels=[1])
+    duplicates = np.zeros(len(index), dtype=bool)
+    if dedup:
+        mask, duplicates = dedup_rows(index, mask)
+    return index, meta, mask, duplicates
+
+
+def task_num_rows(raw_feature_paths, top_families, dedup=True):
+    print(top_families)
+    index, meta, mask, duplicates = task_row_mask(raw_feature_paths, top_families, dedup)
+    return int(np.count_nonzero(mask))
+
+
+def create_task_based_vectorized_features(data_dir, save_dir, top_families, feature_version=2, row_width=None, store_dtype='float32', sparse=False, dedup=True, extra_shards=None):
     """
-    Create feature vectors from raw features and write them to disk
+    Create feature vectors from raw features and write them to disk.
+    With [row_width] set, rows are stored zero-padded to that width.
+    [store_dtype] 'float16' or 'int8' keeps a reduced-precision copy in place of X_train.dat,
+    [sparse] a CSR copy (X_indptr/X_indices/X_data.npy).
+    With [dedup], a sample whose sha256 already occurred is only vectorized once.
+    [extra_shards] are raw feature files read after the seven EMBER 2018 shards.
+    Rows are stored sorted by family label, so every family is one contiguous range of X_train.dat.
     """
     extractor = PEFeatureExtractor(feature_version)
     
     #print(f'Vectorizing {current_task} task data')
     X_path = os.path.join(save_dir, "X_train.dat")
     y_path = os.path.join(save_dir, "y_train.dat")
-    raw_feature_paths_base_tr = [os.path.join(data_dir, "train_features_{}.jsonl".format(i)) for i in range(6)]
-    raw_feature_paths_base_te = [os.path.join(data_dir, "test_features.jsonl")]
-    raw_feature_paths = raw_feature_paths_base_tr + raw_feature_paths_base_te
+    raw_feature_paths = raw_feature_paths_for(data_dir, extra_shards)
+    # shared by both preprocessing scripts and every rerun
+    cache_dir = os.path.join(data_dir, "feature_cache_v{}".format(feature_version))
     
     
     
-    nrows = task_num_rows(raw_feature_paths, top_families)
-    #print(nrows)
-    task_based_vectorize_subset(X_path, y_path, raw_feature_paths, top_families, extractor, nrows)
+    print(top_families)
+    index, meta, mask, duplicates = task_row_mask(raw_feature_paths, top_families, dedup)
+    nrows = int(np.count_nonzero(mask))
+    print(f'{np.count_nonzero(duplicates)} duplicate sha256 rows dropped, {nrows} rows to vectorize')
+    family_labels = np.array([top_families_100_labels.get(family, -1) for family in meta['avclass_vocab']])
+    order, row_order = store_order(family_labels[index['avclass'][mask]])
+    write_metadata_sidecar(save_dir, index, meta, mask, order=order)
+    # a store left by an interrupted run is only resumed if it was started for the same rows and labels
+    fingerprint = selection_fingerprint(load_metadata_sidecar(save_dir)['sha256'], top_families_100_labels)
+    task_based_vectorize_subset(X_path, y_path, raw_feature_paths, top_families, extractor, nrows, cache_dir=cache_dir, row_width=row_width, dedup=dedup, row_order=row_order, fingerprint=fingerprint)
+    finalize_feature_store(save_dir, nrows, row_width or extractor.dim, store_dtype, sparse=sparse)
     #argument_iterator = task_based_vectorize_subset(X_path, y_path, raw_feature_paths, task_months, extractor, nrows)
     
     #return argument_iterator
 
-def read_task_based_vectorized_features(save_dir, feature_version=2):
+def read_task_based_vectorized_features(save_dir, feature_version=2, split_mode='index', seed=0, stratify=None, hash_split=False):
     """
-    Read vectorized features into memory mapped numpy arrays
+    Read vectorized features into memory mapped numpy arrays and split them 90/10.
+    split_mode 'index' only writes seeded train/test row indices into X_train.dat,
+    'npz' writes full copies of both splits to XY_train.npz and XY_test.npz, 'family' writes
+    the row indices and the family offsets table of the (family-sorted) store (see
+    feature_store.write_family_offsets) so the class-IL loader reads only the families it selects.
+    Either way the per-family moments of the train rows are saved to train_moments.npz.
+    The split is seeded by [seed], stratified by [stratify] ('label' or 'family') if given and
+    derived from the samples' sha256 if [hash_split] (see feature_store.split_rows).
     """
 
-    extractor = PEFeatureExtractor(feature_version)
-    ndim = extractor.dim
     X_ = None
     y_ = None
 
 
-    X_path = os.path.join(save_dir, "X_train.dat")
     y_path = os.path.join(save_dir, "y_train.dat")
     
     y_ = np.memmap(y_path, dtype=np.float32, mode="r")
     N = y_.shape[0]
-    
-    X_ = np.memmap(X_path, dtype=np.float32, mode="r", shape=(N, ndim))
+    # float32, float16 or int8 codes as recorded in store.json; rows may be padded
+    X_, scale, offset = open_feature_matrix(save_dir)
     
     print(np.unique(y_))
     
+    strata, digests = split_keys(save_dir, np.arange(N), stratify, hash_split)
+    
+    if split_mode in ('index', 'family'):
+        train_rows, test_rows = write_split_indices(save_dir, np.arange(N), seed=seed, strata=strata, digests=digests)
+        write_split_moments(save_dir, train_rows)
+        if split_mode == 'family':
+            write_family_offsets(save_dir)
+        print(f'train rows {train_rows.shape} test rows {test_rows.shape}')
+        return
+    
     X, Y = X_, y_
     
-    indx = [i for i in range(len(Y))]
-    random.shuffle(indx)
-
-    train_size = int(len(indx)*0.9)
-    trainset = indx[:train_size]
-    testset = indx[train_size:]
+    # seeded, so rerunning gives the same split
+    trainset, testset = split_rows(np.arange(N), seed=seed, strata=strata, digests=digests)
+    write_split_moments(save_dir, trainset)
 
     # Separate the training set
-    X_train = X[trainset]
+    X_train = dequantize(X[trainset], scale, offset)
     Y_train = Y[trainset]
 
     # Separate the test set
-    X_test = X[testset]
+    X_test = dequantize(X[testset], scale, offset)
     Y_test = Y[testset]
     
     
@@ -249,31 +234,15 @@ def read_task_based_vectorized_features(save_dir, feature_version=2):
 #data_dir = "../../ember/ember_data/2018_data/ember2018/"
 data_dir = "/home/bae/continual-learning-malware/ember_data/ember2018/"
 
-families_more_than_400_samples, av_class_stats = get_emberdata_family_stat(data_dir)
-ordered_106_families = sorted(families_more_than_400_samples.items(),key=operator.itemgetter(1),reverse=True)
-
+families_more_than_400_samples, av_class_stats, family_counts = get_emberdata_family_stat(data_dir)
 
-ordered_100_families_keys_100 = []
 num_classes = 100
 
-cnt = 0
-for j in ordered_106_families:
-    #print(j[0], j[1])
-    cnt += 1
-    ordered_100_families_keys_100.append(j[0])
-    if cnt == num_classes:
-        break
-print(len(ordered_100_families_keys_100))
-
-    
-top_families_100_labels = {}
-
-for ind, fam in enumerate(ordered_100_families_keys_100):
-    top_families_100_labels[fam] = int(ind)
-    
-    
+# ranked from the per-family counters instead of re-sorting every family's stats
 all_task_months = ['2018-01', '2018-02', '2018-03', '2018-04', '2018-05', '2018-06',
                    '2018-07', '2018-08', '2018-09', '2018-10', '2018-11', '2018-12']
+ordered_100_families_keys_100, top_families_100_labels = top_families(family_counts, num_classes, all_task_months)
+print(len(ordered_100_families_keys_100))
 
 
 
@@ -287,8 +256,8 @@ save_dir = '/home/bae/continual-learning-malware/top_classes_'+ str(num_classes)
 create_parent_folder(save_dir)
 
 
-create_task_based_vectorized_features(data_dir, save_dir, ordered_100_families_keys_100, feature_version=2)
-read_task_based_vectorized_features(save_dir, feature_version=2)
+create_task_based_vectorized_features(data_dir, save_dir, ordered_100_families_keys_100, feature_version=2, row_width=2401)
+read_task_based_vectorized_features(save_dir, feature_version=2, split_mode='family')
     
     
 end_time = time.time()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import json
+import numpy as np
+from raw_index import get_raw_index
+
+
+def _stats_paths(stats_dir):
+    return os.path.join(stats_dir, "family_counts.npz"), os.path.join(stats_dir, "family_counts.json")
+
+
+# first_seen of a (month, family) pair that has no malware row yet
+NEVER_SEEN = np.iinfo(np.int64).max
+
+
+def empty_family_counts():
+    return {
+        'files': [],
+        'rows': 0,
+        'months': [],
+        'families': [''],
+        'malware': np.zeros((0, 1), dtype=np.int64),
+        'first_seen': np.zeros((0, 1), dtype=np.int64),
+        'goodware': np.zeros(0, dtype=np.int64),
+        'unlabeled': np.zeros(0, dtype=np.int64),
+    }
+
+
+def load_family_counts(stats_dir):
+    """
+    Persisted per-month counters: malware rows per (month, avclass family), the position of
+    the first of them in shard order, and goodware and unlabeled rows per month, plus the
+    shards already folded into them and how many rows those held
+    """
+    counts_path, meta_path = _stats_paths(stats_dir)
+    if not (os.path.exists(counts_path) and os.path.exists(meta_path)):
+        return empty_family_counts()
+    with open(meta_path, "r") as fin:
+        stats = json.load(fin)
+    with np.load(counts_path) as arrays:
+        # counters saved without first_seen are counted again
+        if 'first_seen' not in arrays:
+            return empty_family_counts()
+        for name in ('malware', 'first_seen', 'goodware', 'unlabeled'):
+            stats[name] = arrays[name]
+    return stats
+
+
+def save_family_counts(stats, stats_dir):
+    counts_path, meta_path = _stats_paths(stats_dir)
+    np.savez(counts_path, malware=stats['malware'], first_seen=stats['first_seen'],
+             goodware=stats['goodware'], unlabeled=stats['unlabeled'])
+    with open(meta_path, "w") as fout:
+        json.dump({k: stats[k] for k in ('files', 'rows', 'months', 'families')}, fout)
+
+
+def fold_file(stats, index, meta, file_id):
+    """
+    Add the rows of shard [file_id] of the raw index to the counters, read off its appeared,
+    label and avclass columns, growing the month and family vocabularies as new ones show up.
+    Shards are folded in order, so a row's position in shard order is the number of rows
+    folded before its shard plus its row in the shard.
+    """
+    rows = index[index['file'] == file_id]
+    month_names, month_of_row = np.unique(rows['appeared'], return_inverse=True)
+    months = {month: i for i, month in enumerate(stats['months'])}
+    month_codes = np.array([months.setdefault(month, len(months)) for month in month_names.astype(str)],
+                           dtype=np.int64)[month_of_row]
+
+    labels = rows['label']
+    malware = labels == 1
+    avclass_codes, family_of_row = np.unique(rows['avclass'][malware], return_inverse=True)
+    families = {family: i for i, family in enumerate(stats['families'])}
+    family_codes = np.array([families.setdefault(meta['avclass_vocab'][code], len(families)) for code in avclass_codes],
+                            dtype=np.int64)[family_of_row]
+
+    stats['months'] = list(months)
+    stats['families'] = list(families)
+    grown = np.zeros((len(months), len(families)), dtype=np.int64)
+    grown[:stats['malware'].shape[0], :stats['malware'].shape[1]] = stats['malware']
+    np.add.at(grown, (month_codes[malware], family_codes), 1)
+    stats['malware'] = grown
+
+    grown = np.full((len(months), len(families)), NEVER_SEEN, dtype=np.int64)
+    grown[:stats['first_seen'].shape[0], :stats['first_seen'].shape[1]] = stats['first_seen']
+    np.minimum.at(grown, (month_codes[malware], family_codes), stats['rows'] + np.flatnonzero(malware))
+    stats['first_seen'] = grown
+
+    for name, label in (('goodware', 0), ('unlabeled', -1)):
+        grown = np.zeros(len(months), dtype=np.int64)
+        grown[:len(stats[name])] = stats[name]
+        grown += np.bincount(month_codes[labels == label], minlength=len(months))
+        stats[name] = grown
+    stats['files'].append(meta['files'][file_id])
+    stats['rows'] += len(rows)
+
+
+def update_family_counts(raw_feature_paths, stats_dir=None):
+    """
+    Bring the persisted counters up to date with [raw_feature_paths], folding in only the
+    shards not counted yet (e.g. a newly landed month). Counts are read from the raw index
+    (built on first use), so no shard is parsed for them. A shard that changed or was dropped
+    after being counted cannot be subtracted back out, so that starts the counters over.
+    By default the counters live next to the first shard.
+    """
+    if stats_dir is None:
+        stats_dir = os.path.dirname(os.path.abspath(raw_feature_paths[0]))
+    stats = load_family_counts(stats_dir)
+    index, meta = get_raw_index(raw_feature_paths)
+
+    current = {sig['path']: sig for sig in meta['files']}
+    if any(current.get(sig['path']) != sig for sig in stats['files']):
+        print(f'Raw feature shards changed, recounting families in {stats_dir}')
+        stats = empty_family_counts()
+
+    folded = set(sig['path'] for sig in stats['files'])
+    new_files = [file_id for file_id, sig in enumerate(meta['files']) if sig['path'] not in folded]
+    for file_id in new_files:
+        fold_file(stats, index, meta, file_id)
+    if new_files or not os.path.exists(_stats_paths(stats_dir)[0]):
+        save_family_counts(stats, stats_dir)
+    return stats
+
+
+def _month_rows(stats, task_months):
+    if task_months is None:
+        return slice(None)
+    if isinstance(task_months, str):
+        task_months = [task_months]
+    return [i for i, month in enumerate(stats['months']) if month in task_months]
+
+
+def family_histogram(stats, task_months=None):
+    """
+    Malware rows per family (aligned with stats['families']) over [task_months], all months if None
+    """
+    return stats['malware'][_month_rows(stats, task_months)].sum(axis=0)
+
+
+def family_first_seen(stats, task_months=None):
+    """
+    Position in shard order of each family's first malware row within [task_months]
+    """
+    return stats['first_seen'][_month_rows(stats, task_months)].min(axis=0, initial=NEVER_SEEN)
+
+
+def family_stat(stats, task_months=None):
+    """
+    Malware avclass counts (in order of first appearance, as a scan of the shards would list
+    them) plus goodware and unlabeled row counts for [task_months], answered from the counters
+    """
+    counts = family_histogram(stats, task_months)
+    present = np.flatnonzero(counts)
+    present = present[np.argsort(family_first_seen(stats, task_months)[present], kind='stable')]
+    rows = _month_rows(stats, task_months)
+    av_class_stats = {stats['families'][code]: int(counts[code]) for code in present}
+    return av_class_stats, int(stats['goodware'][rows].sum()), int(stats['unlabeled'][rows].sum())
+
+
+def top_families(stats, num_classes, task_months=None, min_samples=0):
+    """
+    The [num_classes] most frequent named families over [task_months], most frequent first
+    (ties in order of first appearance among the counted rows, i.e. malware of [task_months],
+    as a scan of the shards would meet them), and their label mapping {family: rank}
+    """
+    counts = family_histogram(stats, task_months)
+    order = np.lexsort((family_first_seen(stats, task_months), -counts))
+    ranked = [stats['families'][code] for code in order
+              if counts[code] >= min_samples and counts[code] > 0 and stats['families'][code] != '']
+    ranked = ranked[:num_classes]
+    return ranked, {family: rank for rank, family in enumerate(ranked)}
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import json
+import time
+import numpy as np
+
+
+class FeatureCache(object):
+    """
+    Persistent, content-addressed store of float32 feature vectors keyed by sample sha256.
+
+    The cache directory is specific to one feature_version (PEFeatureExtractor is deterministic
+    per version). Entries live in append-only segments, a '.keys' file of 32 byte digests and
+    a '.f32' file of the matching vectors; every writer process appends to a segment of its
+    own, so pool workers never contend for a file. Lookups go through a sorted digest index
+    built over all segments present when the cache is opened; compact() folds the segments of
+    finished writers into merged segments, which are themselves merged size-tiered.
+    """
+
+    def __init__(self, cache_dir, dim):
+        self.cache_dir = cache_dir
+        self.dim = dim
+        os.makedirs(cache_dir, exist_ok=True)
+        self._check_meta()
+        self._load_segments()
+        self._writer = None
+
+    def _check_meta(self):
+        meta_path = os.path.join(self.cache_dir, "cache.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as fin:
+                meta = json.load(fin)
+            if meta['dim'] != self.dim:
+                raise ValueError(f"feature cache {self.cache_dir} holds {meta['dim']}-dim vectors, not {self.dim}")
+        else:
+            # written under a temporary name and renamed, so a concurrent opener never reads a
+            # half-written cache.json
+            tmp_path = "{}.{}.tmp".format(meta_path, os.getpid())
+            with open(tmp_path, "w") as fout:
+                json.dump({'dim': self.dim}, fout)
+            os.replace(tmp_path, meta_path)
+
+    def _load_segments(self):
+        self._vectors = []
+        self._bases = []
+        keys, segments, rows = [], [], []
+        for name in sorted(os.listdir(self.cache_dir)):
+            if not name.endswith(".keys"):
+                continue
+            keys_path = os.path.join(self.cache_dir, name)
+            vectors_path = keys_path[:-len(".keys")] + ".f32"
+            if not os.path.exists(vectors_path):
+                continue
+            # vectors are written before their key, so a torn tail is dropped here
+            n = min(os.path.getsize(keys_path) // 32, os.path.getsize(vectors_path) // (self.dim * 4))
+            if n == 0:
+                continue
+            keys.append(np.fromfile(keys_path, dtype='S32', count=n))
+            self._vectors.append(np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(n, self.dim)))
+            self._bases.append(keys_path[:-len(".keys")])
+            segments.append(np.full(n, len(self._vectors) - 1, dtype=np.int32))
+            rows.append(np.arange(n, dtype=np.int64))
+
+        if keys:
+            keys, segments, rows = np.concatenate(keys), np.concatenate(segments), np.concatenate(rows)
+        else:
+            keys, segments, rows = np.empty(0, dtype='S32'), np.empty(0, np.int32), np.empty(0, np.int64)
+        order = np.argsort(keys, kind='stable')
+        self._keys, self._segments, self._rows = keys[order], segments[order], rows[order]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, sha256):
+        """
+        Cached feature vector of the sample with hex digest [sha256], or None
+        """
+        digest = np.array(bytes.fromhex(sha256), dtype='S32')
+        pos = np.searchsorted(self._keys, digest)
+        if pos == len(self._keys) or self._keys[pos] != digest:
+            return None
+        return self._vectors[self._segments[pos]][self._rows[pos]]
+
+    def put(self, sha256, feature_vector):
+        """
+        Append a feature vector to this process's segment; visible to caches opened afterwards
+        """
+        if self._writer is None:
+            base = os.path.join(self.cache_dir, "segment-{}-{}".format(os.getpid(), time.time_ns()))
+            # unbuffered: pool workers exit without running finalizers
+            self._writer = (open(base + ".f32", "ab", buffering=0), open(base + ".keys", "ab", buffering=0))
+        vectors_file, keys_file = self._writer
+        vectors_file.write(np.ascontiguousarray(feature_vector, dtype=np.float32).tobytes())
+        keys_file.write(bytes.fromhex(sha256))
+
+    def compact(self, fanout=4, block_rows=65536):
+        """
+        Merge the segments of writers that are no longer running into one segment sorted by
+        digest (dropping repeated digests) and delete them. Merged segments are merged again
+        size-tiered: only once [fanout] of them share a size tier (row counts within a factor of
+        [fanout]) do they become one segment of the next tier. The small per-worker segments
+        are folded on every call while a large merged segment is only rewritten once as much
+        data has piled up next to it, so a vector is copied O(log n) times in all and the number
+        of segments every worker opens stays logarithmic. Called by the parent once its pool
+        has finished; segments written since the cache was opened are picked up first.
+        """
+        self._load_segments()
+        finished = [i for i, base in enumerate(self._bases) if not _is_merged(base) and not _writer_alive(base)]
+        if finished:
+            self._merge(finished, block_rows)
+        while True:
+            tiers = {}
+            for i, base in enumerate(self._bases):
+                if _is_merged(base):
+                    tiers.setdefault(_size_tier(len(self._vectors[i]), fanout), []).append(i)
+            full = [segments for segments in tiers.values() if len(segments) >= fanout]
+            if not full:
+                return
+            self._merge(full[0], block_rows)
+
+    def _merge(self, merged, block_rows):
+        """
+        Write the segments [merged] as one merged segment and delete them
+        """
+        in_merge = np.isin(self._segments, merged)
+        keys, segments, rows = self._keys[in_merge], self._segments[in_merge], self._rows[in_merge]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        keys, segments, rows = keys[first], segments[first], rows[first]
+
+        # vectors are written before their keys, as put() does, so a crash here leaves at worst
+        # a torn segment next to the intact old ones
+        base = os.path.join(self.cache_dir, "segment-merged-{}".format(time.time_ns()))
+        with open(base + ".f32", "wb") as fout:
+            for start in range(0, len(keys), block_rows):
+                block_segments, rows_in_block = segments[start:start + block_rows], rows[start:start + block_rows]
+                block = np.empty((len(rows_in_block), self.dim), dtype=np.float32)
+                for segment in np.unique(block_segments):
+                    in_segment = block_segments == segment
+                    block[in_segment] = self._vectors[segment][rows_in_block[in_segment]]
+                fout.write(block.tobytes())
+        with open(base + ".keys", "wb") as fout:
+            fout.write(np.ascontiguousarray(keys, dtype='S32').tobytes())
+
+        for i in merged:
+            os.remove(self._bases[i] + ".keys")
+            os.remove(self._bases[i] + ".f32")
+        self._load_segments()
+
+
+def _is_merged(base):
+    return os.path.basename(base).startswith("segment-merged-")
+
+
+def _size_tier(nrows, fanout):
+    tier = 0
+    while nrows >= fanout:
+        nrows //= fanout
+        tier += 1
+    return tier
+
+
+def _writer_alive(base):
+    # segments are named segment-<writer pid>-<time>; merged ones have no writer
+    writer = os.path.basename(base).split("-")[1]
+    if not writer.isdigit():
+        return False
+    if int(writer) == os.getpid():
+        return True
+    try:
+        os.kill(int(writer), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
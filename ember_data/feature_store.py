@@ -0,0 +1,834 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import json
+import mmap
+import queue
+import hashlib
+import contextlib
+import multiprocessing
+import numpy as np
+import tqdm
+from feature_cache import FeatureCache
+from raw_index import split_byte_ranges, byte_range_rows, count_range_rows, read_fields, row_matches, is_compressed
+
+
+# Per-process state of a vectorization worker, filled once by init_vectorize_worker so the
+# memmaps and the extractor live for the whole life of the worker instead of one row.
+_worker = {}
+
+
+def done_path_for(X_path):
+    """
+    Completion map kept next to X_train.dat: one byte per row, set once the row is on disk
+    """
+    return os.path.splitext(X_path)[0] + ".done"
+
+
+def selection_path_for(X_path):
+    """
+    Fingerprint of the rows a store was created for, kept next to its completion map
+    """
+    return os.path.splitext(X_path)[0] + ".selection"
+
+
+def selection_fingerprint(digests, label_map=None):
+    """
+    sha256 over the sha256 digests of the selected rows in store order ((n, 32) uint8 or
+    (n,) 'S32', both hash the same bytes), and over [label_map] if the labels come from one
+    """
+    fingerprint = hashlib.sha256(np.ascontiguousarray(digests).tobytes())
+    if label_map is not None:
+        fingerprint.update(json.dumps(label_map, sort_keys=True, default=int).encode())
+    return fingerprint.hexdigest()
+
+
+def read_selection(X_path):
+    selection_path = selection_path_for(X_path)
+    if not os.path.exists(selection_path):
+        return None
+    with open(selection_path, "r") as fin:
+        return fin.read()
+
+
+def open_feature_store(X_path, y_path, nrows, dim, fingerprint=None):
+    """
+    Create X/y and their completion map, or reopen them when a previous run with the same
+    shape and the same selection [fingerprint] (see selection_fingerprint) was interrupted.
+    Returns the completion map.
+    """
+    done_path = done_path_for(X_path)
+    resumable = (os.path.exists(X_path) and os.path.exists(y_path) and os.path.exists(done_path)
+                 and os.path.getsize(X_path) == nrows * dim * 4
+                 and os.path.getsize(y_path) == nrows * 4
+                 and os.path.getsize(done_path) == nrows
+                 and read_selection(X_path) == fingerprint)
+    mode = "r+" if resumable else "w+"
+
+    # Create space on disk to write features to
+    X = np.memmap(X_path, dtype=np.float32, mode=mode, shape=(nrows, dim))
+    y = np.memmap(y_path, dtype=np.float32, mode=mode, shape=nrows)
+    done = np.memmap(done_path, dtype=np.uint8, mode=mode, shape=nrows)
+    del X, y
+
+    # written once the fresh, all-zero completion map is in place
+    if not resumable:
+        remove_selection(X_path)
+        if fingerprint is not None:
+            with open(selection_path_for(X_path), "w") as fout:
+                fout.write(fingerprint)
+
+    if resumable:
+        print(f'Resuming {X_path}: {np.count_nonzero(done)} of {nrows} rows already vectorized')
+    return done
+
+
+def remove_selection(X_path):
+    if os.path.exists(selection_path_for(X_path)):
+        os.remove(selection_path_for(X_path))
+
+
+def verify_feature_store(X_path, nrows):
+    """
+    Raise if any row of the completion map is still missing
+    """
+    done = np.memmap(done_path_for(X_path), dtype=np.uint8, mode="r", shape=nrows)
+    missing = nrows - np.count_nonzero(done)
+    if missing:
+        raise RuntimeError(f'{missing} of {nrows} rows of {X_path} were not vectorized, rerun to resume')
+
+
+def _init_extraction(extractor, label_map, cache_dir):
+    _worker['extractor'] = extractor
+    _worker['label_map'] = label_map
+    _worker['cache'] = None if cache_dir is None else FeatureCache(cache_dir, extractor.dim)
+
+
+def init_vectorize_worker(X_path, y_path, nrows, extractor, label_map=None, cache_dir=None, row_width=None, row_order=None):
+    """
+    Pool initializer: map X/y and the completion map once and keep the extractor (and the
+    feature cache, if any) resident in this worker. X rows are [row_width] wide if given;
+    [row_order] maps the position of a row in the input to its row of the store.
+    """
+    _init_extraction(extractor, label_map, cache_dir)
+    _worker['row_order'] = row_order
+    _worker['X'] = np.memmap(X_path, dtype=np.float32, mode="r+", shape=(nrows, row_width or extractor.dim))
+    _worker['y'] = np.memmap(y_path, dtype=np.float32, mode="r+", shape=nrows)
+    _worker['done'] = np.memmap(done_path_for(X_path), dtype=np.uint8, mode="r+", shape=nrows)
+
+
+def extract_rows(raw_feature_lines):
+    """
+    Feature vectors and labels of a list of raw feature lines. Labels come from [label_map]
+    applied to avclass if the worker has one, else from 'label'. Samples found in the
+    feature cache are copied from it instead of being extracted.
+    """
+    extractor = _worker['extractor']
+    label_map = _worker['label_map']
+    cache = _worker['cache']
+
+    X_block = np.empty((len(raw_feature_lines), extractor.dim), dtype=np.float32)
+    y_block = np.empty(len(raw_feature_lines), dtype=np.float32)
+
+    for j, raw_features_string in enumerate(raw_feature_lines):
+        fields = read_fields(raw_features_string)
+        feature_vector = None if cache is None else cache.get(fields["sha256"])
+        if feature_vector is None:
+            feature_vector = extractor.process_raw_features(json.loads(raw_features_string))
+            if cache is not None:
+                cache.put(fields["sha256"], feature_vector)
+        X_block[j] = feature_vector
+        y_block[j] = fields["label"] if label_map is None else label_map[fields["avclass"]]
+    return X_block, y_block
+
+
+def store_rows(rows):
+    """
+    Store rows of input positions [rows], through the worker's row order if it has one
+    """
+    row_order = _worker['row_order']
+    return rows if row_order is None else row_order[rows]
+
+
+def flush_rows(store, rows):
+    """
+    msync only the pages of the memmap [store] (mapped from the start of its file) that hold
+    [rows], a slice or an array of row indices, rather than the whole mapping
+    """
+    row_bytes = store.strides[0]
+    if isinstance(rows, slice):
+        first, last = rows.start, rows.stop
+    else:
+        first, last = int(rows.min()), int(rows.max()) + 1
+    start = first * row_bytes // mmap.ALLOCATIONGRANULARITY * mmap.ALLOCATIONGRANULARITY
+    store._mmap.flush(start, last * row_bytes - start)
+
+
+def vectorize_chunk(chunk):
+    """
+    Vectorize a chunk of (row index, raw feature line) pairs and write it back as one block.
+    Rows already marked in the completion map are skipped; returns the number of rows written.
+    """
+    extractor = _worker['extractor']
+    done = _worker['done']
+
+    rows = store_rows(np.fromiter((irow for irow, _ in chunk), dtype=np.int64, count=len(chunk)))
+    pending = done[rows] == 0
+    if not pending.any():
+        return 0
+
+    rows = rows[pending]
+    X_block, y_block = extract_rows([line for (_, line), keep in zip(chunk, pending) if keep])
+
+    if np.all(np.diff(rows) == 1):
+        block = slice(int(rows[0]), int(rows[-1]) + 1)
+    else:
+        block = rows
+    # a padded store keeps its zero tail from creation, only the features are written
+    _worker['X'][block, :extractor.dim] = X_block
+    _worker['y'][block] = y_block
+
+    # rows only count as done once their features are flushed, so a crash never leaves a
+    # row marked complete with garbage behind it
+    flush_rows(_worker['X'], block)
+    flush_rows(_worker['y'], block)
+    done[block] = 1
+    flush_rows(done, block)
+    return len(rows)
+
+
+def chunk_rows(raw_feature_lines, chunksize, start=0):
+    """
+    Group raw feature lines into lists of (row index, line) pairs of at most [chunksize]
+    """
+    chunk = []
+    for irow, line in enumerate(raw_feature_lines, start):
+        chunk.append((irow, line))
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@contextlib.contextmanager
+def worker_pool(processes, initializer, initargs):
+    """
+    Pool that is closed and joined when the block exits, or terminated and joined if it
+    raises, so no worker (or its memmaps) outlives the call
+    """
+    pool = multiprocessing.Pool(processes, initializer=initializer, initargs=initargs)
+    try:
+        yield pool
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def _unpack_result(result):
+    ok, value = result
+    if not ok:
+        raise value
+    return value
+
+
+def bounded_imap_unordered(pool, func, tasks, max_in_flight):
+    """
+    pool.imap_unordered with backpressure: [tasks] is only advanced while fewer than
+    [max_in_flight] tasks are submitted but not yet collected. imap_unordered's feeder
+    thread drains its input as fast as it can be produced, which for a generator of raw
+    lines means queueing up the whole dataset in the parent.
+    """
+    finished = queue.Queue()
+    in_flight = 0
+    for task in tasks:
+        while in_flight >= max_in_flight:
+            in_flight -= 1
+            yield _unpack_result(finished.get())
+        pool.apply_async(func, (task,), callback=lambda value: finished.put((True, value)),
+                         error_callback=lambda error: finished.put((False, error)))
+        in_flight += 1
+    while in_flight:
+        in_flight -= 1
+        yield _unpack_result(finished.get())
+
+
+def vectorize_rows(X_path, y_path, raw_feature_lines, extractor, nrows, label_map=None,
+                   chunksize=256, processes=None, cache_dir=None, row_width=None, max_in_flight=None,
+                   row_order=None, fingerprint=None):
+    """
+    Vectorize [nrows] raw feature lines into X/y memmaps with a worker pool,
+    resuming from the completion map if an earlier run was interrupted and
+    consulting the feature cache in [cache_dir] if given. With [row_width] set, X rows are
+    zero-padded to that width on disk (e.g. 2401, the model input) so loaders never pad.
+    With [row_order] (a permutation of the [nrows] input positions) the i-th line is written
+    to row row_order[i], e.g. to store the rows grouped by family (see store_order).
+    A store is only resumed if it was created for the same selection [fingerprint].
+    At most [max_in_flight] chunks of [chunksize] lines (2 per worker by default) are read
+    ahead of the workers, so the parent's memory stays flat whatever the input size.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    done = open_feature_store(X_path, y_path, nrows, row_width or extractor.dim, fingerprint)
+    remaining = nrows - np.count_nonzero(done)
+    del done
+    cache = open_feature_cache(cache_dir, extractor.dim)
+
+    initargs = (X_path, y_path, nrows, extractor, label_map, cache_dir, row_width, row_order)
+    with worker_pool(processes, init_vectorize_worker, initargs) as pool, tqdm.tqdm(total=remaining) as progress:
+        for written in bounded_imap_unordered(pool, vectorize_chunk, chunk_rows(raw_feature_lines, chunksize),
+                                              max_in_flight or 2 * processes):
+            progress.update(written)
+
+    verify_feature_store(X_path, nrows)
+    compact_feature_cache(cache)
+
+
+def open_feature_cache(cache_dir, dim):
+    """
+    Open the feature cache in the parent before its pool starts, so the workers find the
+    directory and cache.json in place instead of racing to create them
+    """
+    return None if cache_dir is None else FeatureCache(cache_dir, dim)
+
+
+def compact_feature_cache(cache):
+    """
+    Fold the segments the finished workers appended to the feature cache (see FeatureCache.compact)
+    """
+    if cache is not None:
+        cache.compact()
+
+
+def range_row_chunks(path, start, end, row_filter, first_row, chunksize, done, row_order=None):
+    """
+    Chunks of (row index, raw feature line) pairs of the rows of one byte range that pass
+    [row_filter], numbered from [first_row]; rows already in the completion map [done]
+    are numbered but left out
+    """
+    irow = first_row
+    chunk = []
+    for offset, line in byte_range_rows(path, start, end):
+        if not row_matches(read_fields(line), row_filter, path, offset):
+            continue
+        if not done[irow if row_order is None else row_order[irow]]:
+            chunk.append((irow, line))
+        irow += 1
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def vectorize_range(args):
+    """
+    Parse, filter and vectorize the rows of one byte range, writing them from [first_row] on
+    """
+    path, start, end, row_filter, first_row, chunksize = args
+    return sum(vectorize_chunk(chunk) for chunk in
+               range_row_chunks(path, start, end, row_filter, first_row, chunksize, _worker['done'], _worker['row_order']))
+
+
+def range_row_counts(ranges, selected_offsets):
+    """
+    Number of selected rows starting in each (path, start, end) byte range, looked up in the
+    sorted line offsets [selected_offsets] of every path. A range that reaches the end of its
+    file takes all remaining offsets, which also covers the one range of a compressed shard
+    (its offsets are positions in the decompressed stream).
+    """
+    counts = []
+    for path, start, end in ranges:
+        offsets = selected_offsets[path]
+        stop = len(offsets) if end >= os.path.getsize(path) else np.searchsorted(offsets, end)
+        counts.append(int(stop - np.searchsorted(offsets, start)))
+    return counts
+
+
+def range_store_rows(row_order, first_row, count):
+    rows = slice(first_row, first_row + count)
+    return rows if row_order is None else row_order[rows]
+
+
+def store_order(keys):
+    """
+    Input positions in the order they are stored to group rows by [keys] (e.g. the rows'
+    family labels), stably, and the inverse permutation to pass as row_order
+    """
+    order = np.argsort(keys, kind='stable')
+    row_order = np.empty(len(order), dtype=np.int64)
+    row_order[order] = np.arange(len(order))
+    return order, row_order
+
+
+def vectorize_byte_ranges(X_path, y_path, raw_feature_paths, row_filter, extractor, nrows, label_map=None,
+                          ranges_per_file=None, chunksize=256, processes=None, cache_dir=None, row_width=None,
+                          selected_offsets=None, row_order=None, fingerprint=None, max_in_flight=None):
+    """
+    Vectorize the rows passing [row_filter] with workers that read their own newline-aligned
+    byte ranges of the shards. A prefix sum of the per-range row counts gives every range its
+    output position, so the parent never reads a line. The counts come from
+    [selected_offsets] ({path: sorted line offsets of the rows the filter keeps}, see
+    raw_index.row_offsets) when the caller has an index, else from a counting pass of the workers.
+    Ranges whose rows are all in the completion map are not read again.
+    A compressed shard is one range, so the parent decompresses and filters it and hands its
+    rows to the whole pool in chunks, at most [max_in_flight] of them ahead of the workers.
+    [cache_dir], [row_width], [row_order] and [fingerprint] are as for vectorize_rows.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    ranges_per_file = ranges_per_file or 4 * processes
+    ranges = [(path, start, end) for path in raw_feature_paths
+              for start, end in split_byte_ranges(path, ranges_per_file)]
+
+    done = open_feature_store(X_path, y_path, nrows, row_width or extractor.dim, fingerprint)
+    cache = open_feature_cache(cache_dir, extractor.dim)
+
+    initargs = (X_path, y_path, nrows, extractor, label_map, cache_dir, row_width, row_order)
+    with worker_pool(processes, init_vectorize_worker, initargs) as pool:
+        if selected_offsets is not None:
+            counts = range_row_counts(ranges, selected_offsets)
+        else:
+            counts = pool.map(count_range_rows, [(path, start, end, row_filter) for path, start, end in ranges])
+        first_rows = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        if sum(counts) != nrows:
+            raise ValueError(f'byte ranges hold {sum(counts)} matching rows, expected {nrows}')
+
+        tasks = [(path, start, end, row_filter, int(first_row), chunksize)
+                 for (path, start, end), first_row, count in zip(ranges, first_rows, counts)
+                 if not done[range_store_rows(row_order, first_row, count)].all()]
+        compressed = [task for task in tasks if is_compressed(task[0])]
+        tasks = [task for task in tasks if not is_compressed(task[0])]
+        remaining = nrows - np.count_nonzero(done)
+
+        # a range task is small, what it reads stays in the worker
+        with tqdm.tqdm(total=remaining) as progress:
+            results = pool.imap_unordered(vectorize_range, tasks)
+            chunks = (chunk for path, start, end, row_filter, first_row, chunksize in compressed
+                      for chunk in range_row_chunks(path, start, end, row_filter, first_row, chunksize, done, row_order))
+            for written in bounded_imap_unordered(pool, vectorize_chunk, chunks, max_in_flight or 2 * processes):
+                progress.update(written)
+            for written in results:
+                progress.update(written)
+        del done
+
+    verify_feature_store(X_path, nrows)
+    compact_feature_cache(cache)
+
+
+def write_metadata_sidecar(save_dir, index, meta, mask, order=None):
+    """
+    Write the per-row metadata of the rows selected by [mask] next to their vectorized
+    features, one memory-mappable .npy per column: dictionary-encoded families, int8 labels,
+    uint8 month codes and raw sha256 digests. Codes index the vocabularies in meta_vocab.json;
+    the family vocabulary is the raw index one, so codes agree across every store of a drop.
+    A store written in [order] (see store_order) gets its metadata in that order.
+    """
+    rows = index[mask]
+    if order is not None:
+        rows = rows[order]
+
+    family_vocab = meta['avclass_vocab']
+    family_dtype = np.int16 if len(family_vocab) <= np.iinfo(np.int16).max else np.int32
+    month_vocab = np.unique(index['appeared'])
+
+    # 'S32' drops trailing zero bytes of a digest on access, the raw buffer keeps them
+    digests = np.frombuffer(np.ascontiguousarray(rows['sha256'], dtype='S32').tobytes(), dtype=np.uint8)
+
+    np.save(os.path.join(save_dir, "meta_family.npy"), rows['avclass'].astype(family_dtype))
+    np.save(os.path.join(save_dir, "meta_label.npy"), rows['label'].astype(np.int8))
+    np.save(os.path.join(save_dir, "meta_month.npy"), np.searchsorted(month_vocab, rows['appeared']).astype(np.uint8))
+    np.save(os.path.join(save_dir, "meta_sha256.npy"), digests.reshape(-1, 32))
+    with open(os.path.join(save_dir, "meta_vocab.json"), "w") as fout:
+        json.dump({'family': family_vocab, 'month': list(month_vocab.astype(str))}, fout)
+
+
+def load_metadata_sidecar(save_dir, mmap_mode='r'):
+    """
+    Memory-map the metadata columns written by write_metadata_sidecar; vocabularies are
+    returned under 'family_vocab' and 'month_vocab'
+    """
+    metadata = {column: np.load(os.path.join(save_dir, "meta_{}.npy".format(column)), mmap_mode=mmap_mode)
+                for column in ('family', 'label', 'month', 'sha256')}
+    with open(os.path.join(save_dir, "meta_vocab.json"), "r") as fin:
+        vocab = json.load(fin)
+    metadata['family_vocab'] = vocab['family']
+    metadata['month_vocab'] = vocab['month']
+    return metadata
+
+
+def digest_hash(digests, seed=0):
+    """
+    Seeded 64 bit hash of (n, 32) uint8 sha256 digests: the leading 8 bytes mixed with the
+    seed through the splitmix64 finalizer, so every seed gives an independent ordering
+    """
+    mixed = np.ascontiguousarray(digests[:, :8]).view('<u8').ravel()
+    mixed = mixed ^ np.uint64((seed * 0x9E3779B97F4A7C15) % 2 ** 64)
+    mixed = (mixed ^ (mixed >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    mixed = (mixed ^ (mixed >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return mixed ^ (mixed >> np.uint64(31))
+
+
+def split_rows(rows, seed=0, train_fraction=0.9, strata=None, digests=None):
+    """
+    Split the store rows [rows] into shuffled train and test rows, identically for identical inputs.
+    Rows are ordered by a permutation from np.random.Generator(seed), or, given their sha256
+    [digests], by digest_hash; without strata a hashed row then goes to train iff its hash falls
+    in the first [train_fraction] of the hash range, so a sample keeps its side whatever else
+    is in the store. With [strata] (e.g. the rows' labels or family codes) every stratum puts
+    the first [train_fraction] of its rows, in that order, into train.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if digests is None:
+        order = np.random.default_rng(seed).permutation(len(rows))
+    else:
+        hashes = digest_hash(digests, seed)
+        order = np.argsort(hashes, kind='stable')
+
+    if strata is None and digests is None:
+        train_size = int(len(rows) * train_fraction)
+        return rows[order[:train_size]], rows[order[train_size:]]
+
+    if strata is None:
+        in_train = (hashes[order] >> np.uint64(11)) * 2.0 ** -53 < train_fraction
+    else:
+        ordered_strata = np.asarray(strata)[order]
+        by_stratum = np.argsort(ordered_strata, kind='stable')
+        _, starts, counts = np.unique(ordered_strata[by_stratum], return_index=True, return_counts=True)
+        rank_in_stratum = np.arange(len(rows)) - np.repeat(starts, counts)
+        in_train = np.empty(len(rows), dtype=bool)
+        in_train[by_stratum] = rank_in_stratum < np.repeat((counts * train_fraction).astype(np.int64), counts)
+    return rows[order[in_train]], rows[order[~in_train]]
+
+
+def split_keys(save_dir, rows, stratify=None, hash_split=False):
+    """
+    (strata, digests) arguments of split_rows for the store rows [rows]: strata are the rows'
+    'label' (y) or 'family' (metadata sidecar) if [stratify] names one, digests their sha256
+    if [hash_split]
+    """
+    strata, digests = None, None
+    if stratify == 'label':
+        strata = np.memmap(os.path.join(save_dir, "y_train.dat"), dtype=np.float32, mode="r")[rows]
+    elif stratify == 'family':
+        strata = load_metadata_sidecar(save_dir)['family'][rows]
+    elif stratify is not None:
+        raise ValueError(f'cannot stratify by {stratify}')
+    if hash_split:
+        digests = load_metadata_sidecar(save_dir)['sha256'][rows]
+    return strata, digests
+
+
+def write_split_indices(save_dir, rows, seed=0, train_fraction=0.9, strata=None, digests=None):
+    """
+    Split the store rows [rows] with split_rows and write the train rows to train_index.npy
+    and the test rows to test_index.npy, with the split's parameters in split.json. Loaders
+    gather the split from X_train.dat through these, so no copy of the features is ever written.
+    """
+    train_rows, test_rows = split_rows(rows, seed=seed, train_fraction=train_fraction, strata=strata, digests=digests)
+    np.save(os.path.join(save_dir, "train_index.npy"), train_rows)
+    np.save(os.path.join(save_dir, "test_index.npy"), test_rows)
+    with open(os.path.join(save_dir, "split.json"), "w") as fout:
+        json.dump({'seed': seed, 'train_fraction': train_fraction, 'stratified': strata is not None,
+                   'hashed': digests is not None, 'ntrain': len(train_rows), 'ntest': len(test_rows)}, fout)
+    return train_rows, test_rows
+
+
+def block_moments(block):
+    """
+    Per-column (count, mean, M2) of a block of rows, in float64
+    """
+    block = np.asarray(block, dtype=np.float64)
+    mean = block.mean(axis=0)
+    return len(block), mean, np.square(block - mean).sum(axis=0)
+
+
+def merge_moments(a, b):
+    """
+    Combine the (count, mean, M2) moments of two disjoint sets of rows (Chan et al.'s
+    parallel form of Welford's update); None stands for no rows
+    """
+    if a is None or a[0] == 0:
+        return b
+    if b is None or b[0] == 0:
+        return a
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (count_b / count)
+    m2 = m2_a + m2_b + np.square(delta) * (count_a * count_b / count)
+    return count, mean, m2
+
+
+def write_split_moments(save_dir, train_rows, block_rows=65536):
+    """
+    Per-label moments (count, mean, M2) of the features of the train rows [train_rows], saved
+    to train_moments.npz. Loaders merge the labels (and months) they use into a
+    StandardScaler instead of refitting one over the data.
+    """
+    X, scale, offset = open_feature_matrix(save_dir)
+    y = np.memmap(os.path.join(save_dir, "y_train.dat"), dtype=np.float32, mode="r")
+    rows = np.sort(np.asarray(train_rows, dtype=np.int64))
+
+    labels = np.unique(y[rows])
+    moments = [None] * len(labels)
+    for start in range(0, len(rows), block_rows):
+        block_index = rows[start:start + block_rows]
+        block = dequantize(X[block_index], scale, offset)
+        codes = np.searchsorted(labels, y[block_index])
+        for code in np.unique(codes):
+            moments[code] = merge_moments(moments[code], block_moments(block[codes == code]))
+
+    np.savez(os.path.join(save_dir, "train_moments.npz"), labels=labels,
+             count=np.array([m[0] for m in moments], dtype=np.int64),
+             mean=np.array([m[1] for m in moments]).reshape(len(labels), X.shape[1]),
+             m2=np.array([m[2] for m in moments]).reshape(len(labels), X.shape[1]))
+
+
+# Stored representations of X: the file written next to y_train.dat and its on-disk dtype.
+# Reduced-precision stores hold q with X ~= q * scale + offset per column.
+STORE_FORMATS = {
+    'float32': ("X_train.dat", np.float32),
+    'float16': ("X_train.f16", np.float16),
+    'int8': ("X_train.q8", np.int8),
+}
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+
+def _column_moments(X, block_rows):
+    lo = np.full(X.shape[1], np.inf)
+    hi = np.full(X.shape[1], -np.inf)
+    total = np.zeros(X.shape[1])
+    total_sq = np.zeros(X.shape[1])
+    for start in range(0, len(X), block_rows):
+        block = np.asarray(X[start:start + block_rows], dtype=np.float64)
+        lo = np.minimum(lo, block.min(axis=0))
+        hi = np.maximum(hi, block.max(axis=0))
+        total += block.sum(axis=0)
+        total_sq += np.square(block).sum(axis=0)
+    return lo, hi, total, total_sq
+
+
+def quantization_params(lo, hi, store_dtype):
+    """
+    Per-column (scale, offset) mapping stored codes back to features. int8 spreads each
+    column's [lo, hi] over the 256 codes; float16 keeps offset 0 and only scales columns
+    by a power of two where they would overflow float16 (sizes, timestamps).
+    """
+    if store_dtype == 'int8':
+        scale = (hi - lo) / 255
+        scale[scale == 0] = 1
+        offset = lo + 128 * scale
+    elif store_dtype == 'float16':
+        with np.errstate(divide='ignore'):
+            scale = 2.0 ** np.maximum(0, np.ceil(np.log2(np.maximum(np.abs(lo), np.abs(hi)) / FLOAT16_MAX)))
+        offset = np.zeros_like(scale)
+    else:
+        raise ValueError(f'unknown store dtype {store_dtype}')
+    return scale.astype(np.float32), offset.astype(np.float32)
+
+
+def quantize(block, scale, offset, store_dtype):
+    codes = (np.asarray(block, dtype=np.float32) - offset) / scale
+    if store_dtype == 'int8':
+        return np.clip(np.rint(codes), -128, 127).astype(np.int8)
+    return codes.astype(np.float16)
+
+
+def dequantize(block, scale, offset):
+    """
+    float32 features of a block of stored rows; float32 stores (scale None) pass through
+    """
+    if scale is None:
+        return np.asarray(block)
+    return np.asarray(block).astype(np.float32) * scale + offset
+
+
+def write_store_info(save_dir, nrows, row_width, store_dtype='float32'):
+    with open(os.path.join(save_dir, "store.json"), "w") as fout:
+        json.dump({'format': 'dense', 'file': STORE_FORMATS[store_dtype][0], 'dtype': store_dtype,
+                   'nrows': nrows, 'row_width': row_width}, fout)
+
+
+def quantize_feature_store(save_dir, nrows, row_width, store_dtype, block_rows=8192, keep_float32=False):
+    """
+    Rewrite the float32 X_train.dat of [save_dir] as a float16 or per-column int8 store and
+    report its size and reconstruction error. The error is the per-column RMS error in units
+    of the column's standard deviation, i.e. what remains of it after StandardScaler.
+    The float32 file (and its completion map) is removed unless [keep_float32].
+    """
+    X_path = os.path.join(save_dir, "X_train.dat")
+    file_name, dtype = STORE_FORMATS[store_dtype]
+    X = np.memmap(X_path, dtype=np.float32, mode="r", shape=(nrows, row_width))
+
+    lo, hi, total, total_sq = _column_moments(X, block_rows)
+    scale, offset = quantization_params(lo, hi, store_dtype)
+
+    Q = np.memmap(os.path.join(save_dir, file_name), dtype=dtype, mode="w+", shape=(nrows, row_width))
+    sq_error = np.zeros(row_width)
+    for start in range(0, nrows, block_rows):
+        block = np.asarray(X[start:start + block_rows])
+        codes = quantize(block, scale, offset, store_dtype)
+        Q[start:start + block_rows] = codes
+        sq_error += np.square(dequantize(codes, scale, offset) - block.astype(np.float64)).sum(axis=0)
+    Q.flush()
+    del Q, X
+    np.save(os.path.join(save_dir, "X_scale.npy"), scale)
+    np.save(os.path.join(save_dir, "X_offset.npy"), offset)
+
+    std = np.sqrt(np.maximum(total_sq / nrows - np.square(total / nrows), 0))
+    varying = std > 0
+    relative_error = np.sqrt(sq_error[varying] / nrows) / std[varying]
+    float32_bytes = nrows * row_width * 4
+    stored_bytes = nrows * row_width * np.dtype(dtype).itemsize
+    print(f'{store_dtype} store of {save_dir}: {stored_bytes} bytes instead of {float32_bytes} '
+          f'({float32_bytes / stored_bytes:.0f}x less to read), RMS error / column std '
+          f'max {relative_error.max(initial=0):.3g} mean {relative_error.mean() if len(relative_error) else 0:.3g}')
+
+    # the reduced-precision store only becomes visible once it is complete
+    write_store_info(save_dir, nrows, row_width, store_dtype)
+    if not keep_float32:
+        os.remove(X_path)
+        os.remove(done_path_for(X_path))
+        remove_selection(X_path)
+    return relative_error
+
+
+def csr_rows_to_dense(indptr, indices, data, rows, ncols):
+    """
+    Dense float32 block of rows [rows] of the CSR matrix (indptr, indices, data)
+    """
+    starts = np.asarray(indptr[rows], dtype=np.int64)
+    lengths = np.asarray(indptr[rows + 1], dtype=np.int64) - starts
+    block_indptr = np.concatenate([[0], np.cumsum(lengths)])
+    positions = np.repeat(starts - block_indptr[:-1], lengths) + np.arange(block_indptr[-1])
+    dense = np.zeros((len(rows), ncols), dtype=np.float32)
+    dense[np.repeat(np.arange(len(rows)), lengths), indices[positions]] = data[positions]
+    return dense
+
+
+class CSRMatrix(object):
+    """
+    Row-indexable view of a CSR store; indexing with rows returns them densified
+    """
+
+    def __init__(self, indptr, indices, data, shape):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.shape = shape
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        rows = np.arange(self.shape[0])[rows]
+        if np.ndim(rows) == 0:
+            return csr_rows_to_dense(self.indptr, self.indices, self.data, rows.reshape(1), self.shape[1])[0]
+        return csr_rows_to_dense(self.indptr, self.indices, self.data, rows, self.shape[1])
+
+
+def write_csr_store(save_dir, nrows, row_width, block_rows=8192, keep_dense=False):
+    """
+    Rewrite the float32 X_train.dat of [save_dir] as CSR arrays X_indptr.npy (int64),
+    X_indices.npy (int32 column ids) and X_data.npy (float32 values), all memory-mappable.
+    Zero padding columns cost nothing in this layout. The dense file (and its completion
+    map) is removed unless [keep_dense].
+    """
+    X_path = os.path.join(save_dir, "X_train.dat")
+    X = np.memmap(X_path, dtype=np.float32, mode="r", shape=(nrows, row_width))
+
+    counts = np.zeros(nrows, dtype=np.int64)
+    for start in range(0, nrows, block_rows):
+        counts[start:start + block_rows] = np.count_nonzero(X[start:start + block_rows], axis=1)
+    indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    nnz = int(indptr[-1])
+
+    indices = np.lib.format.open_memmap(os.path.join(save_dir, "X_indices.npy"), mode="w+", dtype=np.int32, shape=(nnz,))
+    data = np.lib.format.open_memmap(os.path.join(save_dir, "X_data.npy"), mode="w+", dtype=np.float32, shape=(nnz,))
+    for start in range(0, nrows, block_rows):
+        block = np.asarray(X[start:start + block_rows])
+        block_rows_nz, block_cols_nz = np.nonzero(block)
+        first, last = indptr[start], indptr[min(start + block_rows, nrows)]
+        indices[first:last] = block_cols_nz
+        data[first:last] = block[block_rows_nz, block_cols_nz]
+    indices.flush()
+    data.flush()
+    del indices, data, X
+    np.save(os.path.join(save_dir, "X_indptr.npy"), indptr)
+
+    dense_bytes = nrows * row_width * 4
+    csr_bytes = indptr.nbytes + nnz * 8
+    print(f'csr store of {save_dir}: {nnz / max(nrows * row_width, 1):.1%} of entries non-zero, '
+          f'{csr_bytes} bytes instead of {dense_bytes}')
+
+    with open(os.path.join(save_dir, "store.json"), "w") as fout:
+        json.dump({'format': 'csr', 'dtype': 'float32', 'nrows': nrows, 'row_width': row_width, 'nnz': nnz}, fout)
+    if not keep_dense:
+        os.remove(X_path)
+        os.remove(done_path_for(X_path))
+        remove_selection(X_path)
+
+
+def finalize_feature_store(save_dir, nrows, row_width, store_dtype='float32', keep_float32=False, sparse=False):
+    """
+    Record how X of [save_dir] is stored, converting it to [store_dtype] first if that is
+    not float32, or to a float32 CSR store if [sparse]
+    """
+    if sparse:
+        if store_dtype != 'float32':
+            raise ValueError(f'csr stores keep float32 values, not {store_dtype}')
+        write_csr_store(save_dir, nrows, row_width, keep_dense=keep_float32)
+        return
+    if store_dtype == 'float32':
+        write_store_info(save_dir, nrows, row_width)
+        return
+    quantize_feature_store(save_dir, nrows, row_width, store_dtype, keep_float32=keep_float32)
+
+
+def open_feature_matrix(save_dir, mmap_mode='r'):
+    """
+    Memory-map X of [save_dir] as described by store.json; returns (X, scale, offset), with
+    scale and offset None for float32 and CSR stores (the latter densify rows when indexed).
+    Stores written before store.json are float32 X_train.dat files whose row width follows
+    from their size.
+    """
+    store_path = os.path.join(save_dir, "store.json")
+    if not os.path.exists(store_path):
+        X_path = os.path.join(save_dir, "X_train.dat")
+        nrows = os.path.getsize(os.path.join(save_dir, "y_train.dat")) // 4
+        ndim = os.path.getsize(X_path) // (4 * nrows)
+        return np.memmap(X_path, dtype=np.float32, mode=mmap_mode, shape=(nrows, ndim)), None, None
+
+    with open(store_path, "r") as fin:
+        store = json.load(fin)
+    if store.get('format') == 'csr':
+        arrays = [np.load(os.path.join(save_dir, "X_{}.npy".format(name)), mmap_mode=mmap_mode)
+                  for name in ('indptr', 'indices', 'data')]
+        return CSRMatrix(*arrays, shape=(store['nrows'], store['row_width'])), None, None
+    file_name, dtype = STORE_FORMATS[store['dtype']]
+    X = np.memmap(os.path.join(save_dir, file_name), dtype=dtype, mode=mmap_mode,
+                  shape=(store['nrows'], store['row_width']))
+    if store['dtype'] == 'float32':
+        return X, None, None
+    return X, np.load(os.path.join(save_dir, "X_scale.npy")), np.load(os.path.join(save_dir, "X_offset.npy"))
+
+
+def write_family_offsets(save_dir):
+    """
+    Save the offsets table family_offsets.npy of a store written sorted by family label:
+    the rows of family f are offsets[f]:offsets[f + 1] of X_train.dat. Loaders intersect
+    these ranges with a split's sorted row indices to read only the families they select.
+    """
+    y = np.memmap(os.path.join(save_dir, "y_train.dat"), dtype=np.float32, mode="r")
+    labels = np.asarray(y, dtype=np.int64)
+    if np.any(np.diff(labels) < 0):
+        raise ValueError(f'{save_dir} is not stored in family order')
+    offsets = np.searchsorted(labels, np.arange(labels.max(initial=-1) + 2))
+    np.save(os.path.join(save_dir, "family_offsets.npy"), offsets.astype(np.int64))
+    return offsets
@@ -0,0 +1,520 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import re
+import io
+import bz2
+import gzip
+import json
+import lzma
+import hashlib
+import time
+import multiprocessing
+import numpy as np
+import tqdm
+
+
+# One record per raw JSONL row. appeared is kept as the raw 'YYYY-MM' bytes, avclass is
+# dictionary-encoded against the vocabulary stored in the json sidecar and sha256 is the
+# 32 byte digest rather than its 64 character hex string.
+RAW_INDEX_DTYPE = np.dtype([
+    ('file', np.uint8),
+    ('offset', np.uint64),
+    ('length', np.uint32),
+    ('appeared', 'S7'),
+    ('label', np.int8),
+    ('avclass', np.int32),
+    ('sha256', 'S32'),
+])
+
+
+# Every EMBER raw feature record starts with the same five top-level keys, so the fields used
+# for filtering can be read off the head of the line. The pattern is anchored at the opening
+# brace so a nested key can never match; anything else falls back to json.loads.
+_SNIFF_PATTERN = re.compile(
+    rb'\{\s*"sha256":\s*"([0-9a-fA-F]{64})",\s*"md5":\s*"[0-9a-fA-F]*",'
+    rb'\s*"appeared":\s*"([^"\\]*)",\s*"label":\s*(-?\d+),\s*"avclass":\s*"([^"\\]*)"')
+_SNIFF_HEAD_BYTES = 512
+
+
+def sniff_fields(line):
+    """
+    Read sha256, appeared, label and avclass from the head of a raw feature line
+    without decoding the rest of the record. Returns None if the layout is unexpected.
+    """
+    if isinstance(line, str):
+        line = line.encode()
+    match = _SNIFF_PATTERN.match(line, 0, _SNIFF_HEAD_BYTES)
+    if match is None:
+        return None
+    sha256, appeared, label, avclass = match.groups()
+    return {
+        'sha256': sha256.decode(),
+        'appeared': appeared.decode(),
+        'label': int(label),
+        'avclass': avclass.decode(),
+    }
+
+
+def read_fields(line, sniff=True):
+    """
+    Filtering fields of a raw feature line, sniffed when possible and fully decoded otherwise
+    """
+    if sniff:
+        fields = sniff_fields(line)
+        if fields is not None:
+            return fields
+    raw_features = json.loads(line)
+    return {k: raw_features[k] for k in ('sha256', 'appeared', 'label', 'avclass')}
+
+
+def _open_zstd(path):
+    # zstandard is optional, only needed once a .zst shard is actually read
+    import zstandard
+    return io.BufferedReader(zstandard.open(path, "rb"))
+
+
+# Compressed shard suffixes and how to open them as a stream of decompressed bytes
+RAW_SHARD_OPENERS = {
+    '.gz': lambda path: gzip.open(path, "rb"),
+    '.bz2': lambda path: bz2.open(path, "rb"),
+    '.xz': lambda path: lzma.open(path, "rb"),
+    '.zst': _open_zstd,
+}
+
+
+def is_compressed(path):
+    return os.path.splitext(path)[1] in RAW_SHARD_OPENERS
+
+
+def open_raw_shard(path):
+    """
+    Open a raw feature shard for reading lines of bytes, decompressing .gz/.bz2/.xz/.zst
+    shards on the fly
+    """
+    opener = RAW_SHARD_OPENERS.get(os.path.splitext(path)[1])
+    return open(path, "rb") if opener is None else opener(path)
+
+
+def _existing_shard(path):
+    # prefer the plain .jsonl, else whichever compressed copy is there
+    for candidate in [path] + [path + suffix for suffix in RAW_SHARD_OPENERS]:
+        if os.path.exists(candidate):
+            return candidate
+    return path
+
+
+def raw_feature_paths_for(data_dir, extra_shards=None):
+    """
+    Return the seven raw EMBER 2018 JSONL shards in the order the scripts consume them,
+    followed by [extra_shards] (e.g. a newly landed month, relative to [data_dir] or absolute),
+    each as .jsonl or, if only that exists, as .jsonl.gz/.bz2/.xz/.zst
+    """
+    raw_feature_paths_base_tr = [os.path.join(data_dir, "train_features_{}.jsonl".format(i)) for i in range(6)]
+    raw_feature_paths_base_te = [os.path.join(data_dir, "test_features.jsonl")]
+    raw_feature_paths_extra = [os.path.join(data_dir, path) for path in extra_shards or []]
+    return [_existing_shard(path) for path in raw_feature_paths_base_tr + raw_feature_paths_base_te + raw_feature_paths_extra]
+
+
+def _file_signature(path):
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def _index_paths(index_dir):
+    return os.path.join(index_dir, "raw_index.npy"), os.path.join(index_dir, "raw_index.json")
+
+
+def _shard_index_paths(index_dir, path):
+    # one pair of files per shard path; which version of the shard they index is in the json
+    name = "{}.{}".format(os.path.basename(path), hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12])
+    shard_dir = os.path.join(index_dir, "raw_index_shards")
+    return os.path.join(shard_dir, name + ".npy"), os.path.join(shard_dir, name + ".json")
+
+
+def index_range(args):
+    """
+    Index records of the rows starting in one byte range of shard [file_id], with avclass coded
+    against the range's own vocabulary, which is returned too in order of first appearance
+    """
+    file_id, path, start, end, sniff = args
+    vocab = {}
+    records = []
+    for offset, line in byte_range_rows(path, start, end):
+        raw_features = read_fields(line, sniff)
+        records.append((file_id, offset, len(line), raw_features['appeared'].encode(),
+                        raw_features['label'], vocab.setdefault(raw_features['avclass'], len(vocab)),
+                        bytes.fromhex(raw_features['sha256'])))
+    return np.array(records, dtype=RAW_INDEX_DTYPE), list(vocab)
+
+
+def load_shard_index(path, index_dir):
+    """
+    The index records of shard [path] (file id 0, avclass coded against the shard's own
+    vocabulary) and that vocabulary, or None if the shard was not indexed yet or changed since
+    """
+    index_path, meta_path = _shard_index_paths(index_dir, path)
+    if not (os.path.exists(index_path) and os.path.exists(meta_path)):
+        return None
+    with open(meta_path, "r") as fin:
+        meta = json.load(fin)
+    if meta['file'] != _file_signature(path):
+        return None
+    return np.load(index_path), meta['avclass_vocab']
+
+
+def build_shard_indexes(raw_feature_paths, index_dir, sniff=True, processes=None, ranges_per_file=None):
+    """
+    Read every row of [raw_feature_paths] exactly once and save an index per shard, keyed by
+    the shard's signature. Workers index newline-aligned byte ranges of the shards (a compressed
+    shard is one range); the parent concatenates each shard's records in range order and
+    recodes avclass against one vocabulary per shard, in order of first appearance.
+    """
+    shard_dir = os.path.dirname(_shard_index_paths(index_dir, raw_feature_paths[0])[0])
+    os.makedirs(shard_dir, exist_ok=True)
+
+    processes = processes or multiprocessing.cpu_count()
+    ranges_per_file = ranges_per_file or 4 * processes
+    ranges = [(file_id, fp, start, end, sniff) for file_id, fp in enumerate(raw_feature_paths)
+              for start, end in split_byte_ranges(fp, ranges_per_file)]
+
+    parts = [[] for _ in raw_feature_paths]
+    vocabs = [{} for _ in raw_feature_paths]
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.imap(index_range, ranges)
+        for (file_id, _, _, _, _), (records, vocab) in zip(ranges, tqdm.tqdm(results, total=len(ranges), desc='raw index')):
+            codes = vocabs[file_id]
+            recode = np.array([codes.setdefault(avclass, len(codes)) for avclass in vocab], dtype=np.int32)
+            records['file'] = 0
+            records['avclass'] = recode[records['avclass']]
+            parts[file_id].append(records)
+
+    for file_id, fp in enumerate(raw_feature_paths):
+        index_path, meta_path = _shard_index_paths(index_dir, fp)
+        index = np.concatenate(parts[file_id]) if parts[file_id] else np.empty(0, dtype=RAW_INDEX_DTYPE)
+        np.save(index_path, index)
+        # written last, so a shard only counts as indexed once its records are on disk
+        with open(meta_path, "w") as fout:
+            json.dump({'file': _file_signature(fp), 'avclass_vocab': list(vocabs[file_id]),
+                       'nrows': int(len(index))}, fout)
+
+
+def build_raw_index(raw_feature_paths, index_dir, sniff=True, processes=None, ranges_per_file=None):
+    """
+    Write a compact index of (file, byte offset, length, appeared, label, avclass, sha256) of
+    every raw feature row to disk. Only the shards without a current per-shard index (new or
+    changed since, see build_shard_indexes) are read; the per-shard indexes are then
+    concatenated in shard order with avclass recoded against one vocabulary, so adding a
+    shard costs one pass over that shard rather than over all of them.
+    """
+    index_path, meta_path = _index_paths(index_dir)
+    os.makedirs(index_dir, exist_ok=True)
+
+    shards = [load_shard_index(fp, index_dir) for fp in raw_feature_paths]
+    missing = [fp for fp, shard in zip(raw_feature_paths, shards) if shard is None]
+    if missing:
+        print(f'Indexing {len(missing)} of {len(raw_feature_paths)} raw feature shards')
+        build_shard_indexes(missing, index_dir, sniff=sniff, processes=processes, ranges_per_file=ranges_per_file)
+        shards = [shard or load_shard_index(fp, index_dir) for fp, shard in zip(raw_feature_paths, shards)]
+
+    avclass_codes = {'': 0}
+    parts = []
+    for file_id, (records, vocab) in enumerate(shards):
+        recode = np.array([avclass_codes.setdefault(avclass, len(avclass_codes)) for avclass in vocab], dtype=np.int32)
+        records['file'] = file_id
+        records['avclass'] = recode[records['avclass']]
+        parts.append(records)
+    avclass_vocab = list(avclass_codes)
+
+    index = np.concatenate(parts) if parts else np.empty(0, dtype=RAW_INDEX_DTYPE)
+    np.save(index_path, index)
+
+    meta = {
+        'files': [_file_signature(fp) for fp in raw_feature_paths],
+        'avclass_vocab': avclass_vocab,
+        'nrows': int(len(index)),
+    }
+    with open(meta_path, "w") as fout:
+        json.dump(meta, fout)
+
+    return index, meta
+
+
+def load_raw_index(index_dir, mmap_mode='r'):
+    """
+    Load a previously built raw index and its metadata
+    """
+    index_path, meta_path = _index_paths(index_dir)
+    with open(meta_path, "r") as fin:
+        meta = json.load(fin)
+    index = np.load(index_path, mmap_mode=mmap_mode)
+    return index, meta
+
+
+def raw_index_is_current(raw_feature_paths, index_dir):
+    """
+    True if an index exists for exactly these files and none of them changed since it was built
+    """
+    index_path, meta_path = _index_paths(index_dir)
+    if not (os.path.exists(index_path) and os.path.exists(meta_path)):
+        return False
+    with open(meta_path, "r") as fin:
+        meta = json.load(fin)
+    return meta['files'] == [_file_signature(fp) for fp in raw_feature_paths]
+
+
+def get_raw_index(raw_feature_paths, index_dir=None):
+    """
+    Return the raw index for these files, building it on first use or when a shard changed.
+    By default the index lives next to the first shard.
+    """
+    if index_dir is None:
+        index_dir = os.path.dirname(os.path.abspath(raw_feature_paths[0]))
+    if raw_index_is_current(raw_feature_paths, index_dir):
+        return load_raw_index(index_dir)
+    print(f'Building raw feature index in {index_dir}')
+    build_raw_index(raw_feature_paths, index_dir)
+    return load_raw_index(index_dir)
+
+
+def encode_months(task_months):
+    # a single 'YYYY-MM' string selects just that month
+    if isinstance(task_months, str):
+        task_months = [task_months]
+    return np.array([m.encode() for m in task_months], dtype='S7')
+
+
+def avclass_codes_for(meta, families):
+    """
+    Map avclass names to their index codes, dropping names that never occur in the data
+    """
+    lookup = {fam: code for code, fam in enumerate(meta['avclass_vocab'])}
+    return np.array([lookup[fam] for fam in families if fam in lookup], dtype=np.int32)
+
+
+def select_rows(index, meta, task_months=None, families=None, labels=None):
+    """
+    Boolean mask over the index for rows appearing in [task_months], with avclass in
+    [families] and label in [labels]; a None criterion is not applied
+    """
+    mask = np.ones(len(index), dtype=bool)
+    if task_months is not None:
+        mask &= np.isin(index['appeared'], encode_months(task_months))
+    if families is not None:
+        mask &= np.isin(index['avclass'], avclass_codes_for(meta, families))
+    if labels is not None:
+        mask &= np.isin(index['label'], np.asarray(labels, dtype=np.int8))
+    return mask
+
+
+def dedup_rows(index, mask):
+    """
+    Drop from [mask] every row whose sha256 already occurred at an earlier selected row, found
+    with one stable sort of the selected 32 byte digests. Returns the deduplicated mask and
+    the mask of the dropped duplicates.
+    """
+    rows = np.flatnonzero(mask)
+    _, first = np.unique(index['sha256'][rows], return_index=True)
+    repeated = np.ones(len(rows), dtype=bool)
+    repeated[first] = False
+
+    duplicates = np.zeros(len(index), dtype=bool)
+    duplicates[rows[repeated]] = True
+    return mask & ~duplicates, duplicates
+
+
+def row_offsets(raw_feature_paths, index, mask):
+    """
+    {path: sorted array of line offsets} of the rows in [mask]
+    """
+    rows = np.flatnonzero(mask)
+    return {fp: np.sort(index['offset'][rows[index['file'][rows] == file_id]])
+            for file_id, fp in enumerate(raw_feature_paths)}
+
+
+def skipped_offsets(raw_feature_paths, index, mask):
+    """
+    {path: set of line offsets} of the rows in [mask], for row filters of workers that read
+    the shards themselves
+    """
+    return {fp: set(offsets.tolist()) for fp, offsets in row_offsets(raw_feature_paths, index, mask).items()}
+
+
+def index_line_iterator(raw_feature_paths, index, mask):
+    """
+    Yield the raw feature lines of the selected rows, in file order, by seeking to their offsets
+    """
+    rows = np.flatnonzero(mask)
+    files = index['file'][rows]
+    for file_id, fp in enumerate(raw_feature_paths):
+        file_rows = rows[files == file_id]
+        if len(file_rows) == 0:
+            continue
+        offsets = index['offset'][file_rows]
+        lengths = index['length'][file_rows]
+        if is_compressed(fp):
+            for line in _compressed_rows_at(fp, offsets):
+                yield line.decode()
+            continue
+        with open(fp, "rb") as fin:
+            for offset, length in zip(offsets, lengths):
+                fin.seek(int(offset))
+                yield fin.read(int(length)).decode()
+
+
+def _compressed_rows_at(path, offsets):
+    # a compressed stream cannot seek cheaply, so it is read through once and the lines
+    # starting at the (ascending) wanted offsets are picked out on the way
+    wanted = iter(offsets)
+    next_offset = next(wanted, None)
+    pos = 0
+    with open_raw_shard(path) as fin:
+        for line in fin:
+            if next_offset is None:
+                return
+            if pos == next_offset:
+                yield line
+                next_offset = next(wanted, None)
+            pos += len(line)
+
+
+def make_row_filter(task_months=None, families=None, labels=None, skip=None):
+    """
+    Picklable row filter for sniffed fields; a None criterion is not applied.
+    [skip] maps shard paths to line offsets that are dropped regardless (see skipped_offsets).
+    """
+    return {
+        'task_months': None if task_months is None else set(encode_months(task_months).astype(str)),
+        'families': None if families is None else set(families),
+        'labels': None if labels is None else set(labels),
+        'skip': skip,
+    }
+
+
+def row_matches(fields, row_filter, path=None, offset=None):
+    if row_filter.get('skip') and offset in row_filter['skip'].get(path, ()):
+        return False
+    if row_filter['task_months'] is not None and fields['appeared'] not in row_filter['task_months']:
+        return False
+    if row_filter['families'] is not None and fields['avclass'] not in row_filter['families']:
+        return False
+    if row_filter['labels'] is not None and fields['label'] not in row_filter['labels']:
+        return False
+    return True
+
+
+def filtered_line_iterator(raw_feature_paths, task_months=None, families=None, labels=None, sniff=True, dedup=False):
+    """
+    Stream the raw feature lines matching [task_months], [families] and [labels] without an
+    index. Only the sniffed head of each line is inspected; full lines are yielded untouched.
+    With [dedup], a line whose sha256 was already yielded is skipped, as dedup_rows does.
+    """
+    row_filter = make_row_filter(task_months, families, labels)
+    seen = set()
+    for path in raw_feature_paths:
+        with open_raw_shard(path) as fin:
+            for line in fin:
+                fields = read_fields(line, sniff)
+                if not row_matches(fields, row_filter):
+                    continue
+                if dedup:
+                    digest = bytes.fromhex(fields['sha256'])
+                    if digest in seen:
+                        continue
+                    seen.add(digest)
+                yield line.decode()
+
+
+def split_byte_ranges(path, nranges):
+    """
+    Split a JSONL file into at most [nranges] (start, end) byte ranges that begin and end on line boundaries.
+    A compressed shard has no independently decodable ranges and is returned as one range, so
+    the shards, not parts of them, are what gets decompressed in parallel.
+    """
+    size = os.path.getsize(path)
+    if is_compressed(path):
+        return [(0, size)]
+    bounds = [0]
+    with open(path, "rb") as fin:
+        for i in range(1, nranges):
+            target = max(size * i // nranges, bounds[-1], 1)
+            if target >= size:
+                break
+            # reading from the byte before the target lands on the next line start
+            # (or on the target itself when it already starts a line)
+            fin.seek(target - 1)
+            fin.readline()
+            pos = fin.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1) if bounds[i] < bounds[i + 1]]
+
+
+def byte_range_rows(path, start, end):
+    """
+    Yield (offset, line) for the lines of [path] that start inside the byte range [start, end);
+    the one range of a compressed shard yields all of its lines, at decompressed offsets
+    """
+    if is_compressed(path):
+        if start != 0:
+            raise ValueError(f'{path} is compressed and can only be read as a whole')
+        pos = 0
+        with open_raw_shard(path) as fin:
+            for line in fin:
+                yield pos, line
+                pos += len(line)
+        return
+    with open(path, "rb") as fin:
+        fin.seek(start)
+        pos = start
+        while pos < end:
+            line = fin.readline()
+            if not line:
+                break
+            yield pos, line
+            pos += len(line)
+
+
+def count_range_rows(args):
+    """
+    Number of rows in a byte range that pass [row_filter]
+    """
+    path, start, end, row_filter = args
+    return sum(1 for offset, line in byte_range_rows(path, start, end)
+               if row_matches(read_fields(line), row_filter, path, offset))
+
+
+def benchmark_field_sniffing(path, max_lines=100000):
+    """
+    Time reading appeared/label/avclass from the first [max_lines] rows of a shard with
+    json.loads and with the sniffing fast path, and check both agree
+    """
+    lines = []
+    with open_raw_shard(path) as fin:
+        for line in fin:
+            lines.append(line)
+            if len(lines) == max_lines:
+                break
+
+    start_time = time.time()
+    decoded = [read_fields(line, sniff=False) for line in lines]
+    json_time = time.time() - start_time
+
+    start_time = time.time()
+    sniffed = [read_fields(line, sniff=True) for line in lines]
+    sniff_time = time.time() - start_time
+
+    fallbacks = sum(sniff_fields(line) is None for line in lines)
+    assert decoded == sniffed
+
+    print(f'{len(lines)} rows of {path}')
+    print(f'json.loads {len(lines)/json_time:.0f} rows/s, sniffing {len(lines)/sniff_time:.0f} rows/s '
+          f'({json_time/sniff_time:.1f}x), {fallbacks} fallbacks')
+    return json_time, sniff_time
+
+
+if __name__ == '__main__':
+    import sys
+    benchmark_field_sniffing(sys.argv[1])